@@ -9,10 +9,14 @@ default_app_config = 'django_emarsys.apps.DjangoEmarsysConfig'
 
 
 class EventParam(object):
+    __slots__ = ('argument', 'name', 'type_', 'is_list', 'is_string',
+                 'model', '_model_class')
+
     def __init__(self, argument, name, type_):
         self.argument = argument
         self.name = name
         self.type_ = str(type_)
+        self._model_class = None
 
         self.is_list = self.type_[0] == '[' and self.type_[-1] == ']'
 
@@ -24,7 +28,9 @@ class EventParam(object):
             self.model = self.type_
 
     def model_class(self):
-        return django.apps.apps.get_model(self.model)
+        if self._model_class is None:
+            self._model_class = django.apps.apps.get_model(self.model)
+        return self._model_class
 
     def __eq__(self, o):
         return (self.argument == o.argument and
@@ -1,45 +1,428 @@
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
+from __future__ import division, print_function
 from future.builtins import map, filter
+from future.moves.urllib.parse import urlsplit
 
+import base64
+import binascii
+import hashlib
+import json
 import logging
-from itertools import tee, islice as slice
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice as slice
+from multiprocessing.pool import ThreadPool
 
 import emarsys
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import ContactFingerprint, FieldConfiguration
+from .whitelist import get_whitelist
 
 log = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+
+# (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+
+class EmarsysClient(object):
+    """
+    Emarsys API client that keeps connections alive in a pool shared by all
+    threads of the process.
+
+    Errors reported by Emarsys are raised as `emarsys.EmarsysError`, with
+    the HTTP status code available as `status_code`.
+    """
+
+    def __init__(self, username, secret, base_uri,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.username = username
+        self.secret = secret
+        self.base_uri = base_uri.rstrip('/')
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _authentication_header(self):
+        """
+        X-WSSE UsernameToken as required by the Emarsys API.
+        """
+        nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+        created = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        digest = hashlib.sha1((nonce + created + self.secret)
+                              .encode('utf-8')).hexdigest()
+        password_digest = base64.b64encode(digest.encode('ascii'))
+
+        return ('UsernameToken Username="{}", PasswordDigest="{}", '
+                'Nonce="{}", Created="{}"'
+                .format(self.username, password_digest.decode('ascii'),
+                        nonce, created))
+
+    def call(self, uri, method, params=None):
+        headers = {'X-WSSE': self._authentication_header(),
+                   'Content-Type': 'application/json',
+                   'Accept': 'application/json'}
+        data = json.dumps(params) if params is not None else None
+
+        response = self.session.request(method, self.base_uri + uri,
+                                        data=data, headers=headers,
+                                        timeout=self.timeout)
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise self._error(response.text, response.status_code,
+                              response.status_code)
+
+        reply_code = result.get('replyCode', response.status_code)
+        if reply_code != 0:
+            raise self._error(result.get('replyText', response.text),
+                              reply_code, response.status_code)
+
+        return result['data']
+
+    @staticmethod
+    def _error(text, code, status_code):
+        error = emarsys.EmarsysError(text, code)
+        error.status_code = status_code
+        return error
+
+
 _client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
 
 def Client():
-    global _client
-    if not _client:
-        _client = emarsys.Emarsys(settings.EMARSYS_ACCOUNT,
-                                  settings.EMARSYS_PASSWORD,
-                                  settings.EMARSYS_BASE_URI)
+    """
+    Return the `EmarsysClient` of this process, creating it on first use.
+
+    A forked process gets its own client instead of sharing the connections
+    of its parent.
+    """
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = EmarsysClient(
+                    settings.EMARSYS_ACCOUNT,
+                    settings.EMARSYS_PASSWORD,
+                    settings.EMARSYS_BASE_URI,
+                    pool_size=getattr(settings, 'EMARSYS_POOL_SIZE',
+                                      DEFAULT_POOL_SIZE),
+                    timeout=getattr(settings, 'EMARSYS_TIMEOUT',
+                                    DEFAULT_TIMEOUT))
+                _client_pid = os.getpid()
 
     return _client
 
 
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    global _client, _rate_limiter, _contact_transformer
+
+    if setting.startswith('EMARSYS_'):
+        with _client_lock:
+            _client = None
+            _rate_limiter = None
+            _contact_transformer = None
+
+
+# Rate limiting
+# =============
+
+class CacheRateLimitBackend(object):
+    """
+    Keeps token buckets in a Django cache, so that all processes using the
+    same cache share them.
+    """
+
+    LOCK_TIMEOUT = 5
+
+    def __init__(self, alias='default', key_prefix='django_emarsys.rate'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.key_prefix = key_prefix
+
+    def reserve(self, bucket, rate, capacity):
+        key = '{}.{}'.format(self.key_prefix, bucket)
+        lock_key = key + '.lock'
+
+        deadline = time.time() + self.LOCK_TIMEOUT
+        locked = self.cache.add(lock_key, 1, self.LOCK_TIMEOUT)
+        while not locked and time.time() < deadline:
+            time.sleep(0.005)
+            locked = self.cache.add(lock_key, 1, self.LOCK_TIMEOUT)
+
+        # Without the lock, the bucket is updated anyway rather than holding
+        # up the request, but the lock of another process is left alone.
+        try:
+            state = self.cache.get(key)
+            state, wait = _reserve_token(state, rate, capacity, time.time())
+            self.cache.set(key, state, None)
+        finally:
+            if locked:
+                self.cache.delete(lock_key)
+
+        return wait
+
+
+class FileRateLimitBackend(object):
+    """
+    Keeps token buckets in a local file guarded by `flock`, so that all
+    processes on this machine share them. Mostly useful for tests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def reserve(self, bucket, rate, capacity):
+        import fcntl
+
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                buckets = json.loads(f.read() or '{}')
+                buckets[bucket], wait = _reserve_token(
+                    buckets.get(bucket), rate, capacity, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(buckets))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return wait
+
+
+def _reserve_token(state, rate, capacity, now):
+    """
+    Take a token from the bucket described by `state`, which is
+    (tokens, timestamp) or `None` for a full bucket. The bucket may go into
+    debt, the caller then has to wait until it's paid back.
+
+    Returns (new_state, seconds_to_wait)
+    """
+    if state is None:
+        tokens, updated = capacity, now
+    else:
+        tokens, updated = state
+
+    tokens = min(capacity, tokens + max(0, now - updated) * rate) - 1
+    wait = -tokens / rate if tokens < 0 else 0
+
+    return (tokens, now), wait
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter per endpoint family.
+
+    `limits` maps an endpoint family - the first path component after
+    /api/v2/, like 'contact', 'event' or 'contactlist' - to
+    (requests_per_second, burst). Families without limits aren't limited.
+    """
+
+    def __init__(self, limits, backend):
+        self.limits = limits
+        self.backend = backend
+
+    def wait(self, uri):
+        family = _endpoint_family(uri)
+        if family not in self.limits:
+            return
+
+        rate, capacity = self.limits[family]
+        delay = self.backend.reserve(family, rate, capacity)
+        if delay > 0:
+            log.debug("rate limit for '{}' reached, waiting {:.2f}s"
+                      .format(family, delay))
+            time.sleep(delay)
+
+
+def _endpoint_family(uri):
+    path = uri.split('?', 1)[0]
+    if path.startswith('/api/v2/'):
+        path = path[len('/api/v2/'):]
+    return path.strip('/').split('/', 1)[0]
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """
+    Return the `RateLimiter` configured by settings.EMARSYS_RATE_LIMITS and
+    settings.EMARSYS_RATE_LIMIT_BACKEND, or `None` if there are no limits.
+
+    EMARSYS_RATE_LIMIT_BACKEND looks like Django's CACHES entries:
+
+    >>> EMARSYS_RATE_LIMIT_BACKEND = {
+        'BACKEND': 'django_emarsys.api.CacheRateLimitBackend',
+        'OPTIONS': {'alias': 'default'},
+    }
+    """
+    global _rate_limiter
+
+    limits = getattr(settings, 'EMARSYS_RATE_LIMITS', None)
+    if not limits:
+        return None
+
+    if _rate_limiter is None:
+        with _client_lock:
+            if _rate_limiter is None:
+                config = getattr(settings, 'EMARSYS_RATE_LIMIT_BACKEND', {})
+                backend_class = import_string(config.get(
+                    'BACKEND', 'django_emarsys.api.CacheRateLimitBackend'))
+                _rate_limiter = RateLimiter(
+                    limits, backend_class(**config.get('OPTIONS', {})))
+
+    return _rate_limiter
+
+
+# Emarsys errors that won't go away by trying again.
+TERMINAL_ERROR_CODES = frozenset([2008, 5005])
+
+DEFAULT_RETRY_ATTEMPTS = 3
+
+# seconds
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_RETRY_MAX_BACKOFF = 8
+DEFAULT_RETRY_BUDGET = 20
+
+
+# Methods whose requests may be sent twice without harm.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+def _is_retryable(error, method):
+    if isinstance(error, requests.ConnectionError):
+        # A connection can also break after the request was sent, e.g. an
+        # event trigger, which mustn't be sent twice. Only the connection
+        # couldn't be established if connecting failed or timed out.
+        return method in IDEMPOTENT_METHODS or is_connect_error(error)
+
+    if isinstance(error, emarsys.EmarsysError):
+        status_code = getattr(error, 'status_code', None)
+        return (error.code not in TERMINAL_ERROR_CODES and
+                (status_code == 429 or
+                 (status_code is not None and status_code >= 500)))
+
+    return False
+
+
+def is_connect_error(error):
+    """
+    Whether `error` means that a request wasn't sent because no connection
+    could be established, so that it's safe to send it again.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    if not isinstance(error, requests.ConnectionError):
+        return False
+
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def call(uri, method, params=None):
+    """
+    Call the Emarsys API, retrying transient failures.
+
+    See `call_with_attempts`.
+    """
+    result, _ = call_with_attempts(uri, method, params)
+    return result
+
+
+def call_with_attempts(uri, method, params=None):
+    """
+    Call the Emarsys API, retrying rate limited requests, server errors and
+    connection failures with exponential backoff and full jitter. Requests
+    with a method not in IDEMPOTENT_METHODS are only retried after a
+    connection failure if they weren't sent.
+
+    Every attempt waits for the rate limiter, see `get_rate_limiter`.
+
+    The number of attempts is limited by settings.EMARSYS_RETRY_ATTEMPTS,
+    the total time spent waiting by settings.EMARSYS_RETRY_BUDGET. The
+    last error is raised with the number of attempts made as `attempts`.
+
+    Returns (result, number_of_attempts)
+    """
+    max_attempts = getattr(settings, 'EMARSYS_RETRY_ATTEMPTS',
+                           DEFAULT_RETRY_ATTEMPTS)
+    backoff = getattr(settings, 'EMARSYS_RETRY_BACKOFF',
+                      DEFAULT_RETRY_BACKOFF)
+    max_backoff = getattr(settings, 'EMARSYS_RETRY_MAX_BACKOFF',
+                          DEFAULT_RETRY_MAX_BACKOFF)
+    budget = getattr(settings, 'EMARSYS_RETRY_BUDGET', DEFAULT_RETRY_BUDGET)
+
+    attempts = 0
+    waited = 0
+    while True:
+        attempts += 1
+
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            rate_limiter.wait(uri)
+
+        try:
+            return Client().call(uri, method, params), attempts
+        except Exception as e:
+            delay = random.uniform(0, min(max_backoff,
+                                          backoff * 2 ** (attempts - 1)))
+            if (not _is_retryable(e, method) or attempts >= max_attempts or
+                    waited + delay > budget):
+                e.attempts = attempts
+                raise
+
+            log.info("{} {} failed ({}), retrying in {:.2f}s"
+                     .format(method, uri, e, delay))
+            time.sleep(delay)
+            waited += delay
+
+
 BATCH_SIZE = 1000
 
 
 def get_events():
-    response = Client().call('/api/v2/event', 'GET')
+    response = call('/api/v2/event', 'GET')
     return {event['name']: int(event['id']) for event in response}
 
 
 def create_event(name):
-    response = Client().call('/api/v2/event', 'POST', {'name': name})
+    response = call('/api/v2/event', 'POST', {'name': name})
     return response['name'], response['id']
 
 
 def trigger_event(event_id, email, context):
-    Client().call(
+    """
+    Returns the number of attempts it took to trigger the event.
+    """
+    _, attempts = call_with_attempts(
         '/api/v2/event/{}/trigger'.format(event_id), 'POST',
         {
             "key_id": 3,
@@ -47,58 +430,219 @@ def trigger_event(event_id, email, context):
             "data": context
         }
     )
+    return attempts
+
+
+def trigger_event_for_contacts(event_id, contacts):
+    """
+    Trigger the event for many contacts with a single request.
+
+    `contacts` is a list of at most BATCH_SIZE (email, context) tuples.
+
+    Returns
+    (number_of_attempts,
+     {'name@domain.org': {'error_code': 'Error message'}})
+    """
+    assert len(contacts) <= BATCH_SIZE
+
+    result, attempts = call_with_attempts(
+        '/api/v2/event/{}/trigger'.format(event_id), 'POST',
+        {
+            "key_id": 3,
+            "contacts": [{"external_id": email, "data": context}
+                         for email, context in contacts]
+        }
+    )
+
+    errors = result.get('errors', {}) if isinstance(result, dict) else {}
+    return attempts, errors
 
 
 def create_contact(contact):
     contact = _transform_contact_data(contact)
-    Client().call('/api/v2/contact', 'POST', contact)
+    call('/api/v2/contact', 'POST', contact)
+
+
+def create_contacts(contacts):
+    """
+    Create many contacts, BATCH_SIZE per request. See `sync_contacts` for
+    the format of `contacts`.
+
+    Returns
+    (number_of_successful_creates,
+     {'name@domain.org': {'error_code': 'Error message'}})
+    """
+    total_created = 0
+    all_errors = {}
+
+    contacts = map(_transform_contact_data, contacts)
+    while True:
+        chunk_of_contacts = list(slice(contacts, BATCH_SIZE))
+        if not chunk_of_contacts:
+            break
+
+        num_successful, errors = _create_contacts(chunk_of_contacts)
+        total_created += num_successful
+        all_errors.update(errors)
+
+    return total_created, all_errors
 
 
 def get_fields():
     """
     Use this to update settings.EMARSYS_FIELDS.
     """
-    response = Client().call('/api/v2/field', 'GET')
+    response = call('/api/v2/field', 'GET')
     return {field['name']: (field['id'], field['application_type'])
             for field in response}
 
 
-def get_field_choices():
+DEFAULT_FIELD_CHOICES_WORKERS = 8
+
+
+def get_field_choices(fields=None, workers=DEFAULT_FIELD_CHOICES_WORKERS):
+    """
+    Use this to update settings.EMARSYS_FIELD_CHOICES, or use
+    `update_field_configuration`.
+
+    `fields` is the result of `get_fields()`, which is called if it's not
+    given. The choices of the choice fields are requested by `workers`
+    threads.
+    """
+    if fields is None:
+        fields = get_fields()
+
+    choice_fields = [(field_name, field_id)
+                     for field_name, (field_id, field_type) in fields.items()
+                     if field_type in ['multichoice', 'singlechoice']]
+
+    def get_choices(choice_field):
+        field_name, field_id = choice_field
+        url = '/api/v2/field/{}/choice'.format(field_id)
+        return field_name, {choice['choice']: int(choice['id'])
+                            for choice in call(url, 'GET')}
+
+    if workers > 1 and len(choice_fields) > 1:
+        results = _imap_bounded(get_choices, choice_fields, workers,
+                                workers)
+    else:
+        results = map(get_choices, choice_fields)
+
+    return dict(results)
+
+
+def update_field_configuration():
+    """
+    Fetch fields and field choices from emarsys and store them as a new
+    `FieldConfiguration`. Contact data is transformed with the latest stored
+    configuration unless settings.EMARSYS_FIELDS is set.
+
+    Returns the new `FieldConfiguration`.
     """
-    Use this to update settings.EMARSYS_FIELD_CHOICES.
+    global _contact_transformer
+
+    fields = get_fields()
+    field_configuration = FieldConfiguration.objects.create(
+        fields=fields,
+        field_choices=get_field_choices(fields))
+
+    with _client_lock:
+        _contact_transformer = None
+
+    return field_configuration
+
+
+class ContactTransformer(object):
+    """
+    Maps contact data from field names to emarsys field ids and values.
+
+    The field ids and a converter per field are resolved once from
+    `fields` and `field_choices`, which look like settings.EMARSYS_FIELDS
+    and settings.EMARSYS_FIELD_CHOICES.
     """
-    field_choices = {}
-    for field_name, (field_id, field_type) in get_fields().items():
-        if field_type in ['multichoice', 'singlechoice']:
-            url = '/api/v2/field/{}/choice'.format(field_id)
-            choices = Client().call(url, 'GET')
-            field_choices[field_name] = {
-                choice['choice']: int(choice['id'])
-                for choice in choices}
 
-    return field_choices
+    def __init__(self, fields, field_choices):
+        self.fields = {
+            name: (field_id,
+                   self._make_converter(field_type,
+                                        field_choices.get(name)))
+            for name, (field_id, field_type) in fields.items()}
+
+    @staticmethod
+    def _make_converter(field_type, choices):
+        if field_type == 'multichoice' and choices is not None:
+            def convert_multichoice(value):
+                # remove values that are not known in EMARSYS_FIELD_CHOICES
+                return [choices[v] for v in value if v in choices]
+            return convert_multichoice
 
+        if field_type == 'singlechoice':
+            return (choices or {}).get
 
-def _transform_contact_data_field_value(name, value):
-    field_type = settings.EMARSYS_FIELDS[name][1]
-    if field_type == 'multichoice':
-        if name in settings.EMARSYS_FIELD_CHOICES:
-            choices = settings.EMARSYS_FIELD_CHOICES[name]
-            # remove values that are not known in EMARSYS_FIELD_CHOICES
-            return [choices[v]
-                    for v in value
-                    if v in choices]
+        return None
 
-    if field_type == 'singlechoice':
-        return settings.EMARSYS_FIELD_CHOICES.get(name, {}).get(value)
+    def __call__(self, contact):
+        fields = self.fields
+        result = {}
+        for name, value in contact.items():
+            field_id, convert = fields[name]
+            result[field_id] = value if convert is None else convert(value)
+        return result
+
+
+# seconds
+DEFAULT_FIELD_CONFIGURATION_TTL = 60
+
+_contact_transformer = None
+
+# (pk of the `FieldConfiguration` of _contact_transformer,
+#  timestamp of the next check for a newer one)
+_field_configuration_version = (None, 0)
+
+
+def get_contact_transformer():
+    """
+    Return the `ContactTransformer` for settings.EMARSYS_FIELDS and
+    settings.EMARSYS_FIELD_CHOICES. It's rebuilt when settings change.
+
+    Without settings.EMARSYS_FIELDS, the latest `FieldConfiguration` is
+    used. Every settings.EMARSYS_FIELD_CONFIGURATION_TTL seconds (default:
+    60) the transformer checks whether a newer one was stored, e.g. by
+    `update_field_configuration` in another process, and is rebuilt.
+    """
+    global _contact_transformer, _field_configuration_version
 
-    return value
+    if getattr(settings, 'EMARSYS_FIELDS', None) is not None:
+        if _contact_transformer is None:
+            _contact_transformer = ContactTransformer(
+                settings.EMARSYS_FIELDS,
+                getattr(settings, 'EMARSYS_FIELD_CHOICES', {}))
+        return _contact_transformer
+
+    version, check_after = _field_configuration_version
+    if _contact_transformer is None or check_after <= time.time():
+        latest_version = (FieldConfiguration.objects.order_by('-pk')
+                          .values_list('pk', flat=True).first())
+        if latest_version is None:
+            raise FieldConfiguration.DoesNotExist(
+                "no field configuration stored, run emarsys_sync_fields")
+
+        if _contact_transformer is None or latest_version != version:
+            field_configuration = FieldConfiguration.objects.get(
+                pk=latest_version)
+            _contact_transformer = ContactTransformer(
+                field_configuration.fields,
+                field_configuration.field_choices)
+
+        ttl = getattr(settings, 'EMARSYS_FIELD_CONFIGURATION_TTL',
+                      DEFAULT_FIELD_CONFIGURATION_TTL)
+        _field_configuration_version = (latest_version, time.time() + ttl)
+
+    return _contact_transformer
 
 
 def _transform_contact_data(contact):
-    return {settings.EMARSYS_FIELDS[name][0]:
-            _transform_contact_data_field_value(name, value)
-            for name, value in contact.items()}
+    return get_contact_transformer()(contact)
 
 
 def _create_contacts(contacts):
@@ -111,7 +655,7 @@ def _create_contacts(contacts):
 
     log.debug("Attempting to create {} contacts.".format(len(contacts)))
 
-    result = Client().call('/api/v2/contact', 'POST', {'contacts': contacts})
+    result = call('/api/v2/contact', 'POST', {'contacts': contacts})
 
     log.debug("{} contacts created, {} contact creations failed"
               .format(len(result['ids']), len(result.get('errors', {}))))
@@ -123,9 +667,10 @@ def update_contacts(contacts):
     contacts = map(_transform_contact_data, contacts)
 
     # Filter contact data using whitelist
-    if settings.EMARSYS_RECIPIENT_WHITELIST is not None:
+    whitelist = get_whitelist()
+    if whitelist is not None:
         contacts = filter(lambda contact: contact[3]  # 3=email
-                          in settings.EMARSYS_RECIPIENT_WHITELIST, contacts)
+                          in whitelist, contacts)
 
     contacts = list(contacts)
 
@@ -156,7 +701,7 @@ def _update_contacts(contacts):
 
     log.debug("Attempting to update {} contacts.".format(len(contacts)))
 
-    result = Client().call('/api/v2/contact', 'PUT', {'contacts': contacts})
+    result = call('/api/v2/contact', 'PUT', {'contacts': contacts})
 
     log.debug("{} contacts update, {} contact updates failed"
               .format(len(result['ids']), len(result.get('errors', {}))))
@@ -165,13 +710,78 @@ def _update_contacts(contacts):
 
 
 def get_contact_data(email):
-    return Client().call('/api/v2/contact/getdata', 'POST',
-                         {'keyId': '3', 'keyValues': [email]})
+    return call('/api/v2/contact/getdata', 'POST',
+                {'keyId': '3', 'keyValues': [email]})
 
 
-def sync_contacts(contacts, create_missing=True, quiet=True):
+def get_contacts_data(emails, fields=None, workers=1, max_in_flight=None):
+    """
+    Get data of many contacts, requesting BATCH_SIZE emails at a time.
+
+    `fields` is a list of field names from settings.EMARSYS_FIELDS; without
+    it, all fields are returned. Field ids in the results are mapped back to
+    their names, fields without a name keep their id.
+
+    With `workers` > 1, requests are sent by that many threads, see
+    `sync_contacts`.
+
+    Example:
+        dict(get_contacts_data(['a@dom.org', 'b@dom.org'],
+                               fields=['First Name']))
+
+    Yields ('mail@dom.org', {'id': '1', 'First Name': 'A', ...}) for the
+    contacts that exist, in the order of the requested emails.
+    """
+    transformer_fields = get_contact_transformer().fields
+    field_names = {str(field_id): name
+                   for name, (field_id, _) in transformer_fields.items()}
+
+    field_ids = None
+    if fields is not None:
+        # the email is needed to match results to the requested emails
+        field_ids = ['3'] + [str(transformer_fields[name][0])
+                             for name in fields
+                             if transformer_fields[name][0] != 3]
+
+    for email, contact in _get_contacts_data(emails, field_ids, workers,
+                                             max_in_flight):
+        yield email, {field_names.get(field_id, field_id): value
+                      for field_id, value in contact.items()}
+
+
+def _get_contacts_data(emails, field_ids, workers=1, max_in_flight=None):
+    """
+    Yields ('mail@dom.org', {'id': '1', '3': 'mail@dom.org', ...}) for the
+    given emails that belong to a contact.
+    """
+    def get_chunk(chunk_of_emails):
+        params = {'keyId': '3', 'keyValues': list(chunk_of_emails)}
+        if field_ids is not None:
+            params['fields'] = field_ids
+        return chunk_of_emails, call('/api/v2/contact/getdata', 'POST',
+                                     params)
+
+    chunks = _chunked(emails, BATCH_SIZE)
+    if workers > 1:
+        results = _imap_bounded(get_chunk, chunks, workers,
+                                max_in_flight or workers)
+    else:
+        results = map(get_chunk, chunks)
+
+    for chunk_of_emails, result in results:
+        # emarsys compares emails case-insensitively
+        contacts = {contact['3'].lower(): contact
+                    for contact in result.get('result') or []}
+        for email in chunk_of_emails:
+            contact = contacts.get(email.lower())
+            if contact is not None:
+                yield email, contact
+
+
+def sync_contacts(contacts, create_missing=True, quiet=True, workers=1,
+                  max_in_flight=None, delta=False):
     """
-    contacts is a list of dictionaries like this:
+    contacts is an iterable of dictionaries like this:
         [{
             u'E-Mail': u'total-berlin-admin@total.de',
             u'Gender': 2,
@@ -184,23 +794,24 @@ def sync_contacts(contacts, create_missing=True, quiet=True):
     settings.EMARSYS_FIELDS, which can be generated with `get_fields()`.
     Fields in settings.EMARSYS_CREATE_ONLY_FIELDS are not sent when updating a
     contact.
+
+    Contacts are processed in chunks of BATCH_SIZE: each chunk is updated and
+    its missing contacts are created before the next chunk is read, so only
+    one chunk is kept in memory. A queryset is read with `iterator()`.
+
+    With `workers` > 1, chunks are sent by that many threads, with at most
+    `max_in_flight` (default: `workers`) chunks being processed at once.
+    Results are still collected in the order of the chunks. Requests are
+    subject to the rate limits of `call`.
+
+    With `delta` set, only contacts whose data changed since they were last
+    synced successfully in delta mode are sent, see `ContactFingerprint`.
     """
 
     def log_debug(message):
         if not quiet:
             print("{}\n".format(message))
 
-    def chunked(it, n):
-        """
-        From http://stackoverflow.com/a/8991553
-        """
-        it = iter(it)
-        while True:
-            chunk = tuple(slice(it, n))
-            if not chunk:
-                return
-            yield chunk
-
     total_updated = 0
     total_created = 0
 
@@ -212,71 +823,182 @@ def sync_contacts(contacts, create_missing=True, quiet=True):
     # emarsys
     failed_contacts = []
 
+    if hasattr(contacts, 'iterator'):
+        # don't fill the queryset's result cache
+        contacts = contacts.iterator()
+
     contacts = map(_transform_contact_data, contacts)
 
     # Filter contact data using whitelist
-    if settings.EMARSYS_RECIPIENT_WHITELIST is not None:
+    whitelist = get_whitelist()
+    if whitelist is not None:
         contacts = filter(lambda contact: contact[3]  # 3=email
-                          in settings.EMARSYS_RECIPIENT_WHITELIST, contacts)
+                          in whitelist, contacts)
 
-    update_contacts, create_contacts = tee(contacts, 2)
-
-    # Filter out fields in create_only_fields for updating
-    create_only_field_ids = [settings.EMARSYS_FIELDS[field_name][0]
+    transformer_fields = get_contact_transformer().fields
+    create_only_field_ids = {transformer_fields[field_name][0]
                              for field_name in
-                             settings.EMARSYS_CREATE_ONLY_FIELDS]
-    update_contacts = [{k: v for k, v in contact.items()
-                        if k not in create_only_field_ids}
-                       for contact in update_contacts]
+                             settings.EMARSYS_CREATE_ONLY_FIELDS}
 
-    # Update contacts
-    for chunk_of_contacts in chunked(update_contacts, BATCH_SIZE):
-        log_debug("Updating a chunk of {} users."
-                  .format(len(chunk_of_contacts)))
+    if delta:
+        contacts = _changed_contacts(contacts)
 
-        num_successful, errors = _update_contacts(chunk_of_contacts)
-        log_debug('{} users updated, {} users errored.'
-                  .format(num_successful, len(errors)))
+    def sync_chunk(chunk_of_contacts):
+        return chunk_of_contacts, _sync_contacts_chunk(
+            chunk_of_contacts, create_only_field_ids, create_missing,
+            log_debug)
 
-        total_updated += num_successful
+    chunks = _chunked(contacts, BATCH_SIZE)
+    if workers > 1:
+        results = _imap_bounded(sync_chunk, chunks, workers,
+                                max_in_flight or workers)
+    else:
+        results = map(sync_chunk, chunks)
 
-        missing_contacts.extend(email
-                                for email, error_dict in errors.items()
-                                if '2008' in error_dict)
-        failed_contacts.extend((email, error_dict)
-                               for email, error_dict in errors.items()
-                               if '2008' not in error_dict)
+    for chunk_of_contacts, (num_updated, num_created, missing, failed) \
+            in results:
+        if delta:
+            _store_fingerprints(chunk_of_contacts, missing, failed)
 
-    if create_missing:
-        # Find contacts to create in original contact list
-        create_contacts = filter(lambda contact: contact[3] in
-                                 missing_contacts, create_contacts)
+        total_updated += num_updated
+        total_created += num_created
+        missing_contacts.extend(missing)
+        failed_contacts.extend(failed)
 
-        # Create contacts
-        for chunk_of_contacts in chunked(create_contacts, BATCH_SIZE):
-            log_debug("Creating a chunk of {} users."
-                      .format(len(chunk_of_contacts)))
+    return total_updated, total_created, missing_contacts, failed_contacts
 
-            num_successful, errors = _create_contacts(chunk_of_contacts)
-            log_debug('{} users created, {} users errored.'
-                      .format(num_successful, len(errors)))
 
-            total_created += num_successful
+def _fingerprint(contact):
+    """
+    Hash of transformed contact data.
+    """
+    return hashlib.sha1(json.dumps(contact, sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
 
-            failed_contacts.extend((email, error_dict)
-                                   for email, error_dict in errors.items())
 
-        # All contacts were either updated or the update or create failed.
-        missing_contacts = []
+def _changed_contacts(contacts):
+    """
+    Yield the transformed contacts whose fingerprint differs from the stored
+    one. Stored fingerprints are read BATCH_SIZE contacts at a time.
+    """
+    for chunk_of_contacts in _chunked(contacts, BATCH_SIZE):
+        stored_fingerprints = dict(
+            ContactFingerprint.objects
+            .filter(email__in=[contact[3] for contact in chunk_of_contacts])
+            .values_list('email', 'fingerprint'))
+
+        for contact in chunk_of_contacts:
+            if stored_fingerprints.get(contact[3]) != _fingerprint(contact):
+                yield contact
 
-    return total_updated, total_created, missing_contacts, failed_contacts
+
+def _store_fingerprints(contacts, missing_contacts, failed_contacts):
+    """
+    Store the fingerprints of the synced `contacts` that were neither
+    missing nor failed.
+    """
+    unsynced_emails = set(missing_contacts)
+    unsynced_emails.update(email for email, _ in failed_contacts)
+
+    fingerprints = [ContactFingerprint(email=contact[3],
+                                       fingerprint=_fingerprint(contact))
+                    for contact in contacts
+                    if contact[3] not in unsynced_emails]
+    if not fingerprints:
+        return
+
+    with transaction.atomic():
+        ContactFingerprint.objects.filter(
+            email__in=[fingerprint.email for fingerprint in fingerprints]
+        ).delete()
+        ContactFingerprint.objects.bulk_create(fingerprints)
+
+
+def _chunked(it, n):
+    """
+    From http://stackoverflow.com/a/8991553
+    """
+    it = iter(it)
+    while True:
+        chunk = tuple(slice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _imap_bounded(func, iterable, workers, max_in_flight):
+    """
+    Like `ThreadPool.imap`, but reads at most `max_in_flight` items of
+    `iterable` ahead of the results yielded so far.
+    """
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, (item,)))
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _sync_contacts_chunk(contacts, create_only_field_ids, create_missing,
+                         log_debug):
+    """
+    Update a chunk of transformed contacts and create the ones that are
+    missing at emarsys.
+
+    Returns
+    (number_of_successful_updates,
+     number_of_successful_creates,
+     ['missing@domain.org', ...],
+     [('name@domain.org', {'error_code': 'Error message'}), ...])
+    """
+    log_debug("Updating a chunk of {} users.".format(len(contacts)))
+
+    # Filter out fields in create_only_fields for updating
+    num_updated, errors = _update_contacts(
+        [{k: v for k, v in contact.items()
+          if k not in create_only_field_ids}
+         for contact in contacts])
+    log_debug('{} users updated, {} users errored.'
+              .format(num_updated, len(errors)))
+
+    missing_contacts = {email
+                        for email, error_dict in errors.items()
+                        if '2008' in error_dict}
+    failed_contacts = [(email, error_dict)
+                       for email, error_dict in errors.items()
+                       if '2008' not in error_dict]
+
+    if not create_missing or not missing_contacts:
+        return num_updated, 0, sorted(missing_contacts), failed_contacts
+
+    create_contacts = [contact for contact in contacts
+                       if contact[3] in missing_contacts]
+
+    log_debug("Creating a chunk of {} users.".format(len(create_contacts)))
+
+    num_created, errors = _create_contacts(create_contacts)
+    log_debug('{} users created, {} users errored.'
+              .format(num_created, len(errors)))
+
+    failed_contacts.extend((email, error_dict)
+                           for email, error_dict in errors.items())
+
+    # All contacts were either updated or the update or create failed.
+    return num_updated, num_created, [], failed_contacts
 
 
 def unsubscribe_from_campaign(launch_list_id, email_id, contact_uid):
-    Client().call('/api/v2/email/unsubscribe', 'POST',
-                  {'launch_list_id': int(launch_list_id),
-                   'email_id': int(email_id),
-                   'contact_uid': contact_uid})
+    call('/api/v2/email/unsubscribe', 'POST',
+         {'launch_list_id': int(launch_list_id),
+          'email_id': int(email_id),
+          'contact_uid': contact_uid})
 
 
 # Lists
@@ -291,7 +1013,7 @@ def get_lists():
 
     Use this to set settings.EMARSYS_LISTS.
     """
-    result = Client().call('/api/v2/contactlist', 'GET')
+    result = call('/api/v2/contactlist', 'GET')
     return {list['name']: list['id'] for list in result}
 
 
@@ -304,25 +1026,60 @@ def create_list(name):
 
     Returns 'list_id'.
     """
-    result = Client().call('/api/v2/contactlist', 'POST',
-                           {'name': name})
+    result = call('/api/v2/contactlist', 'POST',
+                  {'name': name})
     return result['id']
 
 
 def get_list(name):
     """
-    Get ids of contacts on the list.
+    Get ids of contacts on the list. Use `iter_list` for large lists.
 
     Example:
         get_list('My list')
 
     Returns ['contact_1_id', 'contact_2_id', ...]
     """
+    return list(iter_list(name))
+
+
+LIST_PAGE_SIZE = 10000
+
 
+def iter_list(name, page_size=LIST_PAGE_SIZE):
+    """
+    Iterate over the ids of contacts on the list, requesting `page_size` ids
+    at a time.
+
+    Example:
+        sum(1 for contact_id in iter_list('My list'))
+    """
     list_id = settings.EMARSYS_LISTS[name]
-    result = Client().call('/api/v2/contactlist/{}/contacts'.format(list_id),
-                           'GET')
-    return result
+    uri = ('/api/v2/contactlist/{}/contactIds?$top={}'
+           .format(list_id, page_size))
+
+    while uri:
+        result = call(uri, 'GET')
+        for contact_id in result['value']:
+            yield contact_id
+
+        uri = _relative_uri(result.get('next'))
+
+
+def _relative_uri(url):
+    """
+    Emarsys returns links to further pages as absolute URLs.
+    """
+    if not url:
+        return None
+
+    parts = urlsplit(url)
+    if parts.query:
+        return '{}?{}'.format(parts.path, parts.query)
+    return parts.path
+
+
+LIST_BATCH_SIZE = 1000
 
 
 def replace_contactlist(name, emails):
@@ -330,6 +1087,9 @@ def replace_contactlist(name, emails):
     Replace the contacts on the list with the given name with the contacts
     given in emails.
 
+    The first LIST_BATCH_SIZE emails replace the list, the rest are added in
+    chunks of LIST_BATCH_SIZE. Use `sync_contactlist` to only send changes.
+
     Example:
         replace_contact_list('My list', ['mail1@dom.org', 'mail2@dom.org'])
 
@@ -340,14 +1100,108 @@ def replace_contactlist(name, emails):
     """
 
     list_id = settings.EMARSYS_LISTS[name]
-    result = Client().call('/api/v2/contactlist/{}/replace'.format(list_id),
-                           'POST', {'external_ids': emails})
-    return result['inserted_contacts'], result['errors']
+    chunks = _chunked(emails, LIST_BATCH_SIZE)
+
+    result = call('/api/v2/contactlist/{}/replace'.format(list_id),
+                  'POST', {'external_ids': list(next(chunks, ()))})
+    num_inserted = result['inserted_contacts']
+    errors = _merge_list_errors({}, result['errors'])
+
+    num_added, add_errors = _add_to_contactlist(list_id, chunks)
+    return num_inserted + num_added, _merge_list_errors(errors, add_errors)
 
 
 def add_to_contactlist(name, emails):
+    """
+    Add the contacts given in emails to the list with the given name, in
+    chunks of LIST_BATCH_SIZE.
+
+    Returns (number_of_added_contacts,
+             {'mail@dom.org': {'error_code': 'error message',
+                               ...},
+              ...})
+    """
     list_id = settings.EMARSYS_LISTS[name]
-    result = Client().call('/api/v2/contactlist/{}/add'.format(list_id),
-                           'POST', {'external_ids': emails})
+    return _add_to_contactlist(list_id,
+                               _chunked(emails, LIST_BATCH_SIZE))
+
+
+def remove_from_contactlist(name, emails, key_id=3):
+    """
+    Remove the contacts given in emails from the list with the given name, in
+    chunks of LIST_BATCH_SIZE. With `key_id='id'`, `emails` are contact ids
+    instead.
+
+    Returns (number_of_removed_contacts,
+             {'mail@dom.org': {'error_code': 'error message',
+                               ...},
+              ...})
+    """
+    list_id = settings.EMARSYS_LISTS[name]
+
+    num_removed = 0
+    errors = {}
+    for chunk in _chunked(emails, LIST_BATCH_SIZE):
+        result = call('/api/v2/contactlist/{}/delete'.format(list_id),
+                      'POST', {'key_id': key_id, 'external_ids': list(chunk)})
+        num_removed += result['deleted_contacts']
+        errors = _merge_list_errors(errors, result['errors'])
+
+    return num_removed, errors
+
+
+def sync_contactlist(name, emails):
+    """
+    Make the contacts given in emails the contacts of the list with the
+    given name, sending only the difference to the current list in chunks
+    of LIST_BATCH_SIZE.
+
+    Returns (number_of_added_contacts,
+             number_of_removed_contacts,
+             {'mail@dom.org': {'error_code': 'error message',
+                               ...},
+              ...})
+    """
+    emails = list(emails)
+    current_ids = set(str(contact_id) for contact_id in get_list(name))
+    contact_ids = _get_contact_ids(emails)
+
+    emails_to_add = [email for email in emails
+                     if contact_ids.get(email.lower()) not in current_ids]
+    ids_to_remove = current_ids - set(contact_ids.values())
 
-    return result['inserted_contacts'], result['errors']
+    num_added, errors = add_to_contactlist(name, emails_to_add)
+    num_removed, remove_errors = remove_from_contactlist(
+        name, sorted(ids_to_remove), key_id='id')
+
+    return num_added, num_removed, _merge_list_errors(errors, remove_errors)
+
+
+def _get_contact_ids(emails):
+    """
+    Returns {'mail@dom.org': 'contact_id', ...} for the contacts that exist,
+    with lower case emails.
+    """
+    return {email.lower(): str(contact['id'])
+            for email, contact in _get_contacts_data(emails, ['3'])}
+
+
+def _add_to_contactlist(list_id, chunks):
+    num_added = 0
+    errors = {}
+    for chunk in chunks:
+        result = call('/api/v2/contactlist/{}/add'.format(list_id),
+                      'POST', {'external_ids': list(chunk)})
+        num_added += result['inserted_contacts']
+        errors = _merge_list_errors(errors, result['errors'])
+
+    return num_added, errors
+
+
+def _merge_list_errors(errors, new_errors):
+    """
+    Emarsys reports no errors as an empty list instead of an empty dict.
+    """
+    if new_errors:
+        errors.update(new_errors)
+    return errors
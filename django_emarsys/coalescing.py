@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing `trigger_event` calls that send the same event at about the same
+time into a single request.
+
+It's enabled with
+
+>>> EMARSYS_COALESCE_EVENTS = True
+
+The first caller waits up to settings.EMARSYS_COALESCE_WINDOW seconds
+(default: 0.05) for other threads sending the same Emarsys event, and then
+sends the event to all their recipients at once. A batch is sent right away
+once it has settings.EMARSYS_COALESCE_MAX_RECIPIENTS (default: 100)
+recipients. Every caller gets back its own `EventInstance`.
+
+Only calls within one process are coalesced, so this helps with threaded
+servers.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import api
+
+DEFAULT_COALESCE_WINDOW = 0.05
+DEFAULT_COALESCE_MAX_RECIPIENTS = 100
+
+
+class _Batch(object):
+    def __init__(self):
+        self.events = []
+        self.full = threading.Event()
+        self.sent = threading.Event()
+        self.error = None
+
+
+class EventCoalescer(object):
+    """
+    Collects events per Emarsys event id and sends each batch with
+    `send_batch(events)`, which must not touch the database since it runs in
+    the thread of whichever caller came first.
+    """
+
+    def __init__(self, send_batch, window=DEFAULT_COALESCE_WINDOW,
+                 max_recipients=DEFAULT_COALESCE_MAX_RECIPIENTS):
+        assert max_recipients <= api.BATCH_SIZE
+
+        self.send_batch = send_batch
+        self.window = window
+        self.max_recipients = max_recipients
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def send(self, event):
+        """
+        Send `event` together with the events other threads send meanwhile.
+        Returns once the batch was sent and `event` got its result.
+
+        Exceptions other than `EmarsysError` are raised in every thread
+        whose event was in the failed batch.
+        """
+        with self._lock:
+            batch = self._batches.get(event.emarsys_id)
+            is_first = batch is None
+            if is_first:
+                batch = self._batches[event.emarsys_id] = _Batch()
+
+            batch.events.append(event)
+            if len(batch.events) >= self.max_recipients:
+                del self._batches[event.emarsys_id]
+                batch.full.set()
+
+        if is_first:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batches.get(event.emarsys_id) is batch:
+                    del self._batches[event.emarsys_id]
+
+            try:
+                self.send_batch(batch.events)
+            except Exception as e:
+                batch.error = e
+                raise
+            finally:
+                batch.sent.set()
+        else:
+            batch.sent.wait()
+            if batch.error is not None:
+                raise batch.error
+
+
+_coalescer = None
+_coalescer_pid = None
+_coalescer_lock = threading.Lock()
+
+
+def get_coalescer(send_batch):
+    """
+    Return the `EventCoalescer` of this process if
+    settings.EMARSYS_COALESCE_EVENTS is set, otherwise `None`.
+    """
+    global _coalescer, _coalescer_pid
+
+    if not getattr(settings, 'EMARSYS_COALESCE_EVENTS', False):
+        return None
+
+    if _coalescer is None or _coalescer_pid != os.getpid():
+        with _coalescer_lock:
+            if _coalescer is None or _coalescer_pid != os.getpid():
+                _coalescer = EventCoalescer(
+                    send_batch,
+                    window=getattr(settings, 'EMARSYS_COALESCE_WINDOW',
+                                   DEFAULT_COALESCE_WINDOW),
+                    max_recipients=getattr(
+                        settings, 'EMARSYS_COALESCE_MAX_RECIPIENTS',
+                        DEFAULT_COALESCE_MAX_RECIPIENTS))
+                _coalescer_pid = os.getpid()
+
+    return _coalescer
+
+
+@receiver(setting_changed)
+def _reset_coalescer(setting, **kwargs):
+    global _coalescer
+
+    if setting.startswith('EMARSYS_COALESCE_'):
+        with _coalescer_lock:
+            _coalescer = None
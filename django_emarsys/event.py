@@ -3,24 +3,71 @@
 from __future__ import unicode_literals
 
 import logging
+import sys
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import six, timezone
 from django.utils.html import conditional_escape
 
 from emarsys import EmarsysError
+from requests import RequestException
 
 from . import api, EventParam
+from .coalescing import get_coalescer
 from .context_provider_registry import get_context_provider
 from .exceptions import (BadDataError, DjangoEmarsysError,
                          UnknownEventNameError)
 from .models import Event, EventInstance
+from .whitelist import get_whitelist
 
 log = logging.getLogger(__name__)
 
 
+# (settings.EMARSYS_EVENTS, {event_name: {argument: EventParam}})
+_event_params = (None, {})
+
+
 def get_all_parameters_for_event(event_name):
-    return {argument: get_parameter_for_event(event_name, argument)
-            for argument in settings.EMARSYS_EVENTS[event_name].keys()}
+    """
+    Return {argument: EventParam} for the event, with the model classes
+    resolved. The result is cached for as long as settings.EMARSYS_EVENTS
+    isn't replaced and must not be modified.
+    """
+    global _event_params
+
+    events, event_params = _event_params
+    if events is not settings.EMARSYS_EVENTS:
+        events, event_params = settings.EMARSYS_EVENTS, {}
+        _event_params = (events, event_params)
+
+    try:
+        return event_params[event_name]
+    except KeyError:
+        pass
+
+    params = {argument: get_parameter_for_event(event_name, argument)
+              for argument in events[event_name].keys()}
+
+    for param in params.values():
+        if not param.is_string:
+            try:
+                param.model_class()
+            except (LookupError, ValueError):
+                # raised again when the parameter is used
+                pass
+
+    event_params[event_name] = params
+    return params
 
 
 def get_parameter_for_event(event_name, argument):
@@ -32,23 +79,177 @@ def get_parameter_for_event(event_name, argument):
     )
 
 
-def get_event_id(name):
+# seconds
+DEFAULT_EVENT_ID_CACHE_TTL = 300
+
+EVENT_ID_CACHE_VERSION_KEY = 'django_emarsys.event_id_cache_version'
+
+SYNC_EVENTS_LOCK_KEY = 'django_emarsys.sync_events_lock'
+
+# seconds
+SYNC_EVENTS_LOCK_TIMEOUT = 60
+UNKNOWN_EVENT_BACKOFF = 10
+MAX_UNKNOWN_EVENT_BACKOFF = 600
+
+# name -> (emarsys_id, expiry timestamp)
+_event_id_cache = {}
+_event_id_cache_version = None
+_event_id_cache_lock = threading.Lock()
+
+# names still unknown after syncing -> (timestamp of next sync, backoff)
+_unknown_event_names = {}
+_sync_events_lock = threading.Lock()
+
+
+def _get_shared_cache():
+    """
+    The Django cache configured by settings.EMARSYS_EVENT_ID_CACHE, which
+    tells processes that their event id caches are stale, or `None`.
+    """
+    alias = getattr(settings, 'EMARSYS_EVENT_ID_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _get_cached_event_id(name):
+    global _event_id_cache_version
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        version = shared_cache.get(EVENT_ID_CACHE_VERSION_KEY)
+        if version != _event_id_cache_version:
+            with _event_id_cache_lock:
+                _event_id_cache.clear()
+                _event_id_cache_version = version
+            return None
+
     try:
-        return Event.objects.get(name=name).emarsys_id
-    except Event.DoesNotExist:
-        pass
+        emarsys_id, expires = _event_id_cache[name]
+    except KeyError:
+        return None
+
+    if expires < time.time():
+        return None
+
+    return emarsys_id
+
+
+def _cache_event_id(name, emarsys_id):
+    ttl = getattr(settings, 'EMARSYS_EVENT_ID_CACHE_TTL',
+                  DEFAULT_EVENT_ID_CACHE_TTL)
+    with _event_id_cache_lock:
+        _event_id_cache[name] = (emarsys_id, time.time() + ttl)
+
+
+def invalidate_event_id_cache():
+    """
+    Forget cached Emarsys event ids in this process and, with
+    settings.EMARSYS_EVENT_ID_CACHE set, in all other processes.
+    """
+    with _event_id_cache_lock:
+        _event_id_cache.clear()
+        _unknown_event_names.clear()
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.add(EVENT_ID_CACHE_VERSION_KEY, 0, None)
+        shared_cache.incr(EVENT_ID_CACHE_VERSION_KEY)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def _invalidate_event_id_cache_on_change(**kwargs):
+    invalidate_event_id_cache()
+
+
+@receiver(setting_changed)
+def _invalidate_event_id_cache_on_setting_change(setting, **kwargs):
+    if setting.startswith('EMARSYS_'):
+        with _event_id_cache_lock:
+            _event_id_cache.clear()
+            _unknown_event_names.clear()
+
+
+def get_event_id(name):
+    """
+    Return the Emarsys id of the event `name`, syncing events if it isn't
+    known yet. Ids are cached in the process for
+    settings.EMARSYS_EVENT_ID_CACHE_TTL seconds.
+
+    Only one sync runs at a time, see `_sync_events_single_flight`. If the
+    name is still unknown afterwards, `None` is returned without syncing
+    again for a backoff period that doubles with every unsuccessful sync.
+    """
+    emarsys_id = _get_cached_event_id(name)
+    if emarsys_id is not None:
+        return emarsys_id
 
-    log.info("Emarsys-ID for event '{name}' unknown, "
-             "syncing...".format(name=name))
+    emarsys_id = _get_stored_event_id(name)
+    if emarsys_id is not None:
+        return emarsys_id
 
-    sync_events()
+    with _sync_events_lock:
+        # another thread might have synced while this one was waiting
+        emarsys_id = _get_stored_event_id(name)
+        if emarsys_id is not None:
+            return emarsys_id
 
+        retry_at, backoff = _unknown_event_names.get(name, (0, 0))
+        if retry_at > time.time():
+            return None
+
+        log.info("Emarsys-ID for event '{name}' unknown, "
+                 "syncing...".format(name=name))
+
+        _sync_events_single_flight()
+
+        emarsys_id = _get_stored_event_id(name)
+        if emarsys_id is None:
+            backoff = min(MAX_UNKNOWN_EVENT_BACKOFF,
+                          max(UNKNOWN_EVENT_BACKOFF, backoff * 2))
+            with _event_id_cache_lock:
+                _unknown_event_names[name] = (time.time() + backoff,
+                                              backoff)
+
+        return emarsys_id
+
+
+def _get_stored_event_id(name):
     try:
-        return Event.objects.get(name=name).emarsys_id
+        emarsys_id = Event.objects.get(name=name).emarsys_id
     except Event.DoesNotExist:
-        pass
+        return None
+
+    _cache_event_id(name, emarsys_id)
+    return emarsys_id
+
+
+def _sync_events_single_flight():
+    """
+    Run `sync_events`, unless another process is already doing that. In
+    that case wait for it to finish instead.
+
+    Processes are coordinated through a lock in the Django cache configured
+    by settings.EMARSYS_EVENT_ID_CACHE. Without that setting, only threads
+    of the same process are coordinated by the caller.
+    """
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        sync_events()
+        return
+
+    if shared_cache.add(SYNC_EVENTS_LOCK_KEY, 1, SYNC_EVENTS_LOCK_TIMEOUT):
+        try:
+            sync_events()
+        finally:
+            shared_cache.delete(SYNC_EVENTS_LOCK_KEY)
+        return
 
-    return None
+    deadline = time.time() + SYNC_EVENTS_LOCK_TIMEOUT
+    while (shared_cache.get(SYNC_EVENTS_LOCK_KEY) is not None and
+           time.time() < deadline):
+        time.sleep(0.1)
 
 
 def create_event(name):
@@ -89,29 +290,43 @@ def sync_events():
 
     known_event_names = set(settings.EMARSYS_EVENTS.keys())
 
-    for local_event in Event.objects.all():
-        emarsys_event_id = emarsys_events.get(local_event.name)
-        if not emarsys_event_id or local_event.name not in known_event_names:
-            local_event.delete()
-            num_deleted_ids += 1
-        else:
-            if local_event.emarsys_id != emarsys_event_id:
-                num_updated_ids += 1
-
-            local_event.emarsys_id = emarsys_event_id
-            del emarsys_events[local_event.name]
-            local_event.save()
-
-    for emarsys_event_name, emarsys_event_id in emarsys_events.items():
-        if emarsys_event_name not in known_event_names:
-            continue
-
-        Event.objects.create(emarsys_id=emarsys_event_id,
-                             name=emarsys_event_name)
-        num_new_events += 1
-
-    all_synced_event_names = set(Event.objects.all()
-                                 .values_list('name', flat=True))
+    local_events = dict(Event.objects.values_list('name', 'emarsys_id'))
+
+    deleted_event_names = {
+        name for name in local_events
+        if not emarsys_events.get(name) or name not in known_event_names}
+    updated_event_ids = {
+        name: emarsys_events[name]
+        for name, emarsys_id in local_events.items()
+        if name not in deleted_event_names and
+        emarsys_events[name] != emarsys_id}
+    new_events = [
+        Event(name=name, emarsys_id=emarsys_id)
+        for name, emarsys_id in emarsys_events.items()
+        if name in known_event_names and name not in local_events]
+
+    if deleted_event_names or updated_event_ids or new_events:
+        with transaction.atomic():
+            if deleted_event_names:
+                Event.objects.filter(name__in=deleted_event_names).delete()
+
+            if updated_event_ids:
+                Event.objects.filter(name__in=updated_event_ids).update(
+                    emarsys_id=Case(*[When(name=name, then=Value(emarsys_id))
+                                      for name, emarsys_id
+                                      in updated_event_ids.items()],
+                                    output_field=IntegerField()))
+
+            Event.objects.bulk_create(new_events)
+
+        invalidate_event_id_cache()
+
+    num_new_events = len(new_events)
+    num_updated_ids = len(updated_event_ids)
+    num_deleted_ids = len(deleted_event_names)
+
+    all_synced_event_names = ((set(local_events) - deleted_event_names) |
+                              set(event.name for event in new_events))
     unsynced_event_names = list(known_event_names - all_synced_event_names)
 
     if unsynced_event_names:
@@ -142,12 +357,42 @@ def trigger_event(event_name, recipient_email, data=None,
 
     emarsys_event_id = get_event_id(event_name)
 
-    event = _create_event_instance(
-        event_name=event_name,
-        recipient_email=recipient_email,
-        emarsys_event_id=emarsys_event_id,
-        source=source,
-        data=data)
+    if getattr(settings, 'EMARSYS_QUEUE_EVENTS', False):
+        # The event is only validated and stored here, it's sent by
+        # `send_queued_events()`, see the `emarsys_send_events` command.
+        if contact_data_provider is not None:
+            log.warning("contact_data_provider is ignored for queued events,"
+                        " missing contacts are created with their email "
+                        "address only")
+
+        return _create_event_instance(
+            event_name=event_name,
+            recipient_email=recipient_email,
+            emarsys_event_id=emarsys_event_id,
+            source=source,
+            data=data,
+            send=False,
+            create_user_if_needed=create_user_if_needed)
+
+    coalescer = get_coalescer(_send_coalesced_event_instances)
+    if coalescer is not None:
+        # see `django_emarsys.coalescing`
+        event = _build_event_instance(
+            event_name=event_name,
+            recipient_email=recipient_email,
+            emarsys_event_id=emarsys_event_id,
+            source=source,
+            data=data)
+        if event.state == EventInstance.STATE_SENDING:
+            _send_event_instance_or_save_error(event, coalescer.send)
+        event.save()
+    else:
+        event = _create_event_instance(
+            event_name=event_name,
+            recipient_email=recipient_email,
+            emarsys_event_id=emarsys_event_id,
+            source=source,
+            data=data)
 
     if (event.state == EventInstance.STATE_ERROR
             and event.result_code == '2008'
@@ -169,11 +414,296 @@ def trigger_event(event_name, recipient_email, data=None,
     return event
 
 
+def trigger_events(event_name, recipients, create_user_if_needed=True,
+                   manual=False):
+    """
+    Trigger the event `event_name` for many recipients at once.
+
+    `recipients` is an iterable of (recipient_email, data) tuples, where
+    `data` is what would be passed to `trigger_event`.
+
+    The event is sent to up to `api.BATCH_SIZE` recipients with a single
+    request and the `EventInstance` objects of each batch are inserted with
+    `bulk_create` right after it was sent. Contacts unknown to Emarsys are
+    created with just their email address if `create_user_if_needed` is set.
+
+    A connection problem fails the events of its batch only. Other errors
+    are raised once the events of their batch are stored.
+
+    With settings.EMARSYS_QUEUE_EVENTS set, the events are only stored, like
+    with `trigger_event`.
+
+    :returns: a list of event objects in the order of `recipients`. Their
+              primary keys are only set on databases where `bulk_create`
+              returns them.
+    """
+    if manual:
+        source = EventInstance.SOURCE_MANUAL
+    else:
+        source = EventInstance.SOURCE_AUTOMATIC
+
+    emarsys_event_id = get_event_id(event_name)
+
+    events = [_build_event_instance(
+                  event_name=event_name,
+                  recipient_email=recipient_email,
+                  emarsys_event_id=emarsys_event_id,
+                  source=source,
+                  data=data)
+              for recipient_email, data in recipients]
+
+    queued = getattr(settings, 'EMARSYS_QUEUE_EVENTS', False)
+    if queued:
+        for event in events:
+            event.create_user_if_needed = create_user_if_needed
+
+    for i in range(0, len(events), api.BATCH_SIZE):
+        batch = events[i:i + api.BATCH_SIZE]
+
+        sendable_events = [event for event in batch
+                           if event.state == EventInstance.STATE_SENDING]
+        exc_info = None
+        if sendable_events and not queued:
+            try:
+                _send_event_instances(sendable_events, create_user_if_needed)
+            except Exception as e:
+                if not isinstance(e, RequestException):
+                    exc_info = sys.exc_info()
+                log.error(e, exc_info=True)
+                for event in sendable_events:
+                    if event.state == EventInstance.STATE_SENDING:
+                        _handle_send_exception(event, e)
+
+        # Events that were sent are stored before the next batch is sent, so
+        # that they aren't lost if that fails.
+        EventInstance.objects.bulk_create(batch)
+
+        if exc_info is not None:
+            six.reraise(*exc_info)
+
+    return events
+
+
+def _send_event_instances(events, create_user_if_needed):
+    """
+    Send the same event to the recipients of all `events` with a single
+    request, without saving them.
+    """
+    try:
+        attempts, errors = api.trigger_event_for_contacts(
+            events[0].emarsys_id,
+            [(event.recipient_email, event.context) for event in events])
+    except EmarsysError as e:
+        if e.code not in api.TERMINAL_ERROR_CODES:
+            log.error(e, exc_info=True)
+        for event in events:
+            event.attempts += getattr(e, 'attempts', 1)
+            event.handle_emarsys_error(e, save=False)
+        return
+
+    missing_contact_events = []
+    for event in events:
+        event.attempts += attempts
+        error_dict = errors.get(event.recipient_email)
+        if not error_dict:
+            event.handle_success(save=False)
+        elif '2008' in error_dict and create_user_if_needed:
+            missing_contact_events.append(event)
+        else:
+            code, message = next(iter(error_dict.items()))
+            event.handle_emarsys_error(EmarsysError(message, int(code)),
+                                       save=False)
+
+    if missing_contact_events:
+        api.create_contacts({'E-Mail': event.recipient_email}
+                            for event in missing_contact_events)
+        _send_event_instances(missing_contact_events,
+                              create_user_if_needed=False)
+
+
+def _send_coalesced_event_instances(events):
+    # Missing contacts are created by `trigger_event`, which knows the
+    # `contact_data_provider` of each event.
+    _send_event_instances(events, create_user_if_needed=False)
+
+
+QUEUE_BATCH_SIZE = 100
+
+# Seconds a worker may take to send the events it claimed before other
+# workers consider them abandoned and claim them again.
+QUEUE_LEASE = 300
+
+# Queued events that couldn't be sent after this many attempts fail.
+DEFAULT_QUEUE_MAX_ATTEMPTS = 10
+
+
+def send_queued_events(limit=None, threads=1, batch_size=QUEUE_BATCH_SIZE,
+                       lease=QUEUE_LEASE):
+    """
+    Send events that were queued by `trigger_event` because
+    settings.EMARSYS_QUEUE_EVENTS is set, oldest first.
+
+    Events are claimed in batches of `batch_size` by setting their
+    `locked_until` lease, so any number of workers can run this in parallel
+    without sending an event twice. Each batch is sent by `threads` threads;
+    the database is only written to from the calling thread.
+
+    Contacts unknown to Emarsys are created with just their email address
+    if the event was triggered with `create_user_if_needed`, as a
+    `contact_data_provider` can't be stored with the queued event.
+
+    Events that couldn't be sent because no connection could be established
+    stay queued and are retried once their lease expired, until they took
+    settings.EMARSYS_QUEUE_MAX_ATTEMPTS attempts (default: 10). Any other
+    error fails the event, as it may have been sent already.
+
+    :return: (num_sent_events, num_failed_events)
+    """
+    num_sent_events = 0
+    num_failed_events = 0
+
+    pool = ThreadPool(threads) if threads > 1 else None
+    map_ = pool.imap_unordered if pool else map
+
+    try:
+        while True:
+            size = batch_size
+            if limit is not None:
+                size = min(size,
+                           limit - num_sent_events - num_failed_events)
+                if size <= 0:
+                    break
+
+            events = _claim_queued_events(size, lease)
+            if not events:
+                break
+
+            for event, error in map_(_deliver_queued_event, events):
+                _handle_queued_event_result(event, error)
+                if event.state == EventInstance.STATE_SUCCESS:
+                    num_sent_events += 1
+                else:
+                    num_failed_events += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return num_sent_events, num_failed_events
+
+
+def send_queued_event(event):
+    """
+    Send a single queued `EventInstance` to Emarsys.
+
+    :returns: the event object
+    """
+    _handle_queued_event_result(*_deliver_queued_event(event))
+    return event
+
+
+def _claim_queued_events(limit, lease):
+    now = timezone.now()
+
+    with transaction.atomic():
+        pks = list(EventInstance.objects
+                   .select_for_update(skip_locked=True)
+                   .filter(state=EventInstance.STATE_SENDING)
+                   .filter(Q(locked_until__isnull=True) |
+                           Q(locked_until__lt=now))
+                   .order_by('when', 'pk')
+                   .values_list('pk', flat=True)[:limit])
+
+        EventInstance.objects.filter(pk__in=pks).update(
+            locked_until=now + timedelta(seconds=lease))
+
+    return list(EventInstance.objects.filter(pk__in=pks)
+                .order_by('when', 'pk'))
+
+
+def _deliver_queued_event(event):
+    """
+    Send `event` to Emarsys without touching the database, so that this can
+    run in a worker thread.
+
+    :return: (event, exception or None)
+    """
+    try:
+        try:
+            _trigger_queued_event(event)
+        except EmarsysError as e:
+            if str(e.code) != '2008' or not event.create_user_if_needed:
+                raise
+
+            api.create_contact({'E-Mail': event.recipient_email})
+            _trigger_queued_event(event)
+    except Exception as e:
+        return event, e
+
+    return event, None
+
+
+def _trigger_queued_event(event):
+    try:
+        event.attempts += api.trigger_event(
+            event.emarsys_id, event.recipient_email, event.context)
+    except Exception as e:
+        event.attempts += getattr(e, 'attempts', 1)
+        raise
+
+
+def _handle_queued_event_result(event, error):
+    if error is None:
+        event.handle_success(save=False)
+    elif isinstance(error, EmarsysError):
+        if error.code not in api.TERMINAL_ERROR_CODES:
+            log.error(error)
+        event.handle_emarsys_error(error, save=False)
+    elif (api.is_connect_error(error) and event.attempts <
+            getattr(settings, 'EMARSYS_QUEUE_MAX_ATTEMPTS',
+                    DEFAULT_QUEUE_MAX_ATTEMPTS)):
+        # Leave the event queued, it's claimed again once the lease expired.
+        log.error("sending event id={} failed: {}".format(event.id, error))
+    else:
+        log.error("sending event id={} failed: {}".format(event.id, error))
+        event.handle_error("Sending failed: {}".format(error), save=False)
+
+    event.save(update_fields=['state', 'result', 'result_code', 'attempts'])
+
+
 def _create_event_instance(event_name, recipient_email, emarsys_event_id,
-                           source, data):
+                           source, data, send=True,
+                           create_user_if_needed=True):
+    """
+    A `EventInstance` object is created with a single INSERT, see
+    `_build_event_instance`.
+
+    If `send` is `False` a valid event is left in `STATE_SENDING` for
+    `send_queued_events()` instead of being sent right away, which creates
+    a missing contact if `create_user_if_needed` is set.
+
+    :returns: the new event object
+
+    """
+    event = _build_event_instance(event_name, recipient_email,
+                                  emarsys_event_id, source, data)
+    event.create_user_if_needed = create_user_if_needed
+
+    # Sent events are only inserted once their outcome is known, so that
+    # creating an event takes a single write.
+    if send and event.state == EventInstance.STATE_SENDING:
+        _send_event_instance_or_save_error(event, _send_event_instance)
+
+    event.save()
+
+    return event
+
+
+def _build_event_instance(event_name, recipient_email, emarsys_event_id,
+                          source, data):
     """
-    A `EventInstance` object is instantiated. All data validation is
-    done here, passing along correct user `data`.
+    A `EventInstance` object is instantiated, but not saved. All data
+    validation is done here, passing along correct user `data`.
 
     Upon any error the resulting event instance's will store the error message
     and get the appropriate state.
@@ -181,7 +711,7 @@ def _create_event_instance(event_name, recipient_email, emarsys_event_id,
     :returns: the new event object
 
     """
-    event = EventInstance.objects.create(
+    event = EventInstance(
         event_name=event_name,
         recipient_email=recipient_email,
         source=source,
@@ -191,65 +721,111 @@ def _create_event_instance(event_name, recipient_email, emarsys_event_id,
         data = {}
 
     try:
-        context = {'global': {
-            key: conditional_escape(value)
-            for key, value
-            in get_placeholder_data(event.event_name, **data).items()}}
-
-        event.set_context(context)
-
-        if event_name not in settings.EMARSYS_EVENTS:
-            raise UnknownEventNameError(event_name)
-
-        event_params = get_all_parameters_for_event(event_name)
-
-        expected_params = set(event_params.keys())
-        given_params = set(data.keys())
+        event.set_context(_get_context(event_name, data), save=False)
 
-        if given_params != expected_params:
-            raise BadDataError(expected_params, given_params)
-
-        for param in event_params.values():
-            if param.is_string:
-                pass
-            elif param.is_list:
-                class_ = param.model_class()
-                for arg in data[param.argument]:
-                    if not isinstance(arg, class_):
-                        raise ValueError("expected list of '{model}' for "
-                                         "argument '{argument}': '{value}'"
-                                         .format(model=param.model,
-                                                 argument=param.argument,
-                                                 value=arg))
-            elif not isinstance(data[param.argument], param.model_class()):
-                raise ValueError("expected instance of '{model}' for "
-                                 "argument '{argument}': '{value}'"
-                                 .format(model=param.model,
-                                         argument=param.argument,
-                                         value=data[param.argument]))
-
-            event.set_parameter(param, data[param.argument])
+        for param in _validate_data(event_name, data):
+            event.set_parameter(param, data[param.argument], save=False)
     except (DjangoEmarsysError, ValueError) as e:
-        event.handle_error(e)
+        event.handle_error(e, save=False)
         return event
 
     if not emarsys_event_id:
-        event.handle_error("Emarsys-ID unknown")
+        event.handle_error("Emarsys-ID unknown", save=False)
         return event
 
-    if getattr(settings, 'EMARSYS_RECIPIENT_WHITELIST', None) is not None:
-        if recipient_email not in settings.EMARSYS_RECIPIENT_WHITELIST:
+    whitelist = get_whitelist()
+    if whitelist is not None:
+        if recipient_email not in whitelist:
             event.handle_error("User not on whitelist: {}"
-                               .format(recipient_email))
+                               .format(recipient_email), save=False)
             return event
 
+    return event
+
+
+def _get_context(event_name, data):
+    return {'global': {
+        key: conditional_escape(value)
+        for key, value
+        in get_placeholder_data(event_name, **data).items()}}
+
+
+def _validate_data(event_name, data):
+    """
+    Check `data` against the parameters configured for the event.
+
+    :returns: the event's parameters
+    """
+    if event_name not in settings.EMARSYS_EVENTS:
+        raise UnknownEventNameError(event_name)
+
+    event_params = get_all_parameters_for_event(event_name)
+
+    expected_params = set(event_params.keys())
+    given_params = set(data.keys())
+
+    if given_params != expected_params:
+        raise BadDataError(expected_params, given_params)
+
+    for param in event_params.values():
+        if param.is_string:
+            pass
+        elif param.is_list:
+            class_ = param.model_class()
+            for arg in data[param.argument]:
+                if not isinstance(arg, class_):
+                    raise ValueError("expected list of '{model}' for "
+                                     "argument '{argument}': '{value}'"
+                                     .format(model=param.model,
+                                             argument=param.argument,
+                                             value=arg))
+        elif not isinstance(data[param.argument], param.model_class()):
+            raise ValueError("expected instance of '{model}' for "
+                             "argument '{argument}': '{value}'"
+                             .format(model=param.model,
+                                     argument=param.argument,
+                                     value=data[param.argument]))
+
+    return event_params.values()
+
+
+def _handle_send_exception(event, exception):
+    """
+    Record an exception other than `EmarsysError`, e.g. a connection error,
+    that was raised while sending `event`, without saving it.
+    """
+    event.attempts += getattr(exception, 'attempts', 1)
+    event.handle_error("Sending failed: {}".format(exception), save=False)
+
+
+def _send_event_instance_or_save_error(event, send):
+    """
+    Send `event` with `send(event)`. If that raises anything but an
+    `EmarsysError`, `event` is saved with the error before it's raised.
+    """
     try:
-        api.trigger_event(emarsys_event_id, recipient_email, context)
+        send(event)
+    except Exception as e:
+        exc_info = sys.exc_info()
+        _handle_send_exception(event, e)
+        event.save()
+        # a bare raise could re-raise an exception handled while saving on
+        # Python 2
+        six.reraise(*exc_info)
+
+
+def _send_event_instance(event):
+    """
+    Send `event` without saving it.
+    """
+    try:
+        event.attempts += api.trigger_event(
+            event.emarsys_id, event.recipient_email, event.context)
     except EmarsysError as e:
-        if e.code not in [2008, 5005]:
+        event.attempts += getattr(e, 'attempts', 1)
+        if e.code not in api.TERMINAL_ERROR_CODES:
             log.error(e, exc_info=True)
-        event.handle_emarsys_error(e)
-        return event
+        event.handle_emarsys_error(e, save=False)
+        return
 
-    event.handle_success()
-    return event
+    event.handle_success(save=False)
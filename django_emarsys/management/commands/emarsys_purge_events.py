@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from django.core.management import BaseCommand
+
+from ...retention import BATCH_SIZE, purge_event_instances
+
+
+class Command(BaseCommand):
+    help = ("Delete event instances older than settings."
+            "EMARSYS_EVENT_RETENTION allows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive', default=None,
+                            help="Append deleted event instances to this "
+                                 "gzip compressed JSON lines file.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Number of event instances deleted per "
+                                 "transaction.")
+        parser.add_argument('--pause', type=float, default=0,
+                            help="Seconds to sleep between transactions.")
+
+    def handle(self, *args, **options):
+        num_deleted = purge_event_instances(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            archive_path=options['archive'])
+
+        for state, num in sorted(num_deleted.items()):
+            print("{} event instances in state '{}' deleted"
+                  .format(num, state))
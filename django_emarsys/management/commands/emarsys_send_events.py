@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import time
+
+from django.core.management import BaseCommand
+
+from ...event import QUEUE_BATCH_SIZE, QUEUE_LEASE, send_queued_events
+
+
+class Command(BaseCommand):
+    help = "Send events queued with settings.EMARSYS_QUEUE_EVENTS."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help="Send at most this many events per run.")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep running and look for queued events "
+                                 "every INTERVAL seconds.")
+        parser.add_argument('--threads', type=int, default=1,
+                            help="Number of threads sending events.")
+        parser.add_argument('--batch-size', type=int,
+                            default=QUEUE_BATCH_SIZE,
+                            help="Number of events claimed at once.")
+        parser.add_argument('--lease', type=int, default=QUEUE_LEASE,
+                            help="Seconds after which claimed events that "
+                                 "weren't sent may be claimed again.")
+
+    def handle(self, *args, **options):
+        while True:
+            num_sent_events, num_failed_events = send_queued_events(
+                limit=options['limit'],
+                threads=options['threads'],
+                batch_size=options['batch_size'],
+                lease=options['lease'])
+            if (options['interval'] is None or num_sent_events
+                    or num_failed_events):
+                print("{} events sent, {} events failed"
+                      .format(num_sent_events, num_failed_events))
+
+            if options['interval'] is None:
+                return
+
+            time.sleep(options['interval'])
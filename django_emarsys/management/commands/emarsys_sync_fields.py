@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from django.core.management import BaseCommand
+
+from ...api import update_field_configuration
+
+
+class Command(BaseCommand):
+    help = "Store the current emarsys fields and field choices."
+
+    def handle(self, *args, **options):
+        field_configuration = update_field_configuration()
+        print("{} fields, {} choice fields stored as version {}"
+              .format(len(field_configuration.fields),
+                      len(field_configuration.field_choices),
+                      field_configuration.pk))
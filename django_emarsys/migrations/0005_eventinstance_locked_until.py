@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fail_unfinished_eventinstances(apps, schema_editor):
+    """
+    Events used to be stored in state 'sending' before they were sent, so
+    events still in that state were interrupted by a crash or connection
+    error and may have been sent. They must not be picked up by
+    `send_queued_events`.
+    """
+    EventInstance = apps.get_model('django_emarsys', 'EventInstance')
+    EventInstance.objects.filter(state='sending').update(
+        state='error', result="Sending was interrupted")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_emarsys', '0004_delete_old_and_rename_new_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventinstance',
+            name='locked_until',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.RunPython(fail_unfinished_eventinstances,
+                             migrations.RunPython.noop),
+    ]
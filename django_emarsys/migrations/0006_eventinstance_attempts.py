@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_emarsys', '0005_eventinstance_locked_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventinstance',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
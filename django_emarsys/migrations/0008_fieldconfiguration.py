@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_emarsys', '0007_contactfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldConfiguration',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('fields', jsonfield.fields.JSONField()),
+                ('field_choices', jsonfield.fields.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'get_latest_by': 'pk',
+            },
+            bases=(models.Model,),
+        ),
+    ]
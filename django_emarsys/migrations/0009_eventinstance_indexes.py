@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_emarsys', '0008_fieldconfiguration'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='eventinstance',
+            name='result_code',
+            field=models.CharField(max_length=16, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='eventinstance',
+            name='source',
+            field=models.CharField(max_length=16, choices=[('automatic', 'automatic'), ('manual', 'manual')]),
+        ),
+        migrations.AlterField(
+            model_name='eventinstance',
+            name='state',
+            field=models.CharField(default='sending', max_length=16, choices=[('sending', 'sending'), ('error', 'error'), ('success', 'success')]),
+        ),
+        migrations.AddIndex(
+            model_name='eventinstance',
+            index=models.Index(fields=['state', 'when'], name='emarsys_ei_state_when_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventinstance',
+            index=models.Index(fields=['event_name', 'when'], name='emarsys_ei_event_when_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventinstance',
+            index=models.Index(fields=['recipient_email', 'when'], name='emarsys_ei_recipient_when_idx'),
+        ),
+    ]
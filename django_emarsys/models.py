@@ -5,6 +5,7 @@ from future.builtins import str
 
 import logging
 
+import django.apps
 from jsonfield import JSONField
 
 from django.db import models
@@ -34,6 +35,73 @@ class Event(models.Model):
         return self.name
 
 
+def resolve_parameters(event_instances):
+    """
+    Resolve the stored parameters of all `event_instances` with one query
+    per model, instead of one per parameter like `get_parameter`.
+
+    Afterwards `get_parameter` and `get_all_parameters` of the instances
+    return the resolved objects without querying. Values of list parameters
+    are lists instead of querysets.
+    """
+    pks_by_model = {}
+    for event_instance in event_instances:
+        for argument, (name, type_, pk) in (event_instance.data or {}).items():
+            param = EventParam(argument=argument, name=name, type_=type_)
+            if param.is_string:
+                continue
+            pks = pks_by_model.setdefault(param.model, set())
+            if param.is_list:
+                pks.update(pk)
+            else:
+                pks.add(pk)
+
+    objects_by_model = {
+        model: django.apps.apps.get_model(model).objects.in_bulk(list(pks))
+        for model, pks in pks_by_model.items()}
+
+    for event_instance in event_instances:
+        parameters = {}
+        for argument, (name, type_, pk) in (event_instance.data or {}).items():
+            param = EventParam(argument=argument, name=name, type_=type_)
+            if param.is_string:
+                value = pk
+            elif param.is_list:
+                objects = objects_by_model[param.model]
+                value = [objects[x] for x in pk if x in objects]
+            else:
+                value = objects_by_model[param.model].get(pk)
+            parameters[argument] = (value, param)
+
+        event_instance._parameters = parameters
+
+
+class EventInstanceQuerySet(models.QuerySet):
+    _with_parameters = False
+
+    def with_parameters(self):
+        """
+        Resolve the parameters of all fetched instances in bulk, see
+        `resolve_parameters`.
+        """
+        clone = self._clone()
+        clone._with_parameters = True
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super(EventInstanceQuerySet, self)._clone(**kwargs)
+        clone._with_parameters = self._with_parameters
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(EventInstanceQuerySet, self)._fetch_all()
+
+        if fetched and self._with_parameters:
+            resolve_parameters([result for result in self._result_cache
+                                if isinstance(result, EventInstance)])
+
+
 @python_2_unicode_compatible
 class EventInstance(models.Model):
     STATE_SENDING = "sending"
@@ -55,30 +123,49 @@ class EventInstance(models.Model):
     context = JSONField(null=True)
     data = JSONField()
     when = models.DateTimeField(auto_now_add=True)
-    source = models.CharField(max_length=1024, choices=SOURCE_CHOICES)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
     result = models.CharField(max_length=1024, blank=True)
-    result_code = models.CharField(max_length=1024, blank=True)
-    state = models.CharField(max_length=1024, choices=STATE_CHOICES,
+    result_code = models.CharField(max_length=16, blank=True)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES,
                              default=STATE_SENDING)
     emarsys_id = models.IntegerField(null=True, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # whether a queued event creates a missing contact when it's sent
+    create_user_if_needed = models.BooleanField(default=True)
+
+    objects = EventInstanceQuerySet.as_manager()
 
-    def handle_error(self, msg):
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'when'],
+                         name='emarsys_ei_state_when_idx'),
+            models.Index(fields=['event_name', 'when'],
+                         name='emarsys_ei_event_when_idx'),
+            models.Index(fields=['recipient_email', 'when'],
+                         name='emarsys_ei_recipient_when_idx'),
+        ]
+
+    def handle_error(self, msg, save=True):
         log.warning("error for event id={}: {}".format(self.id, msg))
         self.result = str(msg)
         self.state = EventInstance.STATE_ERROR
-        self.save()
+        if save:
+            self.save()
 
-    def handle_emarsys_error(self, emarsys_error):
+    def handle_emarsys_error(self, emarsys_error, save=True):
         log.warning("emarsys error for event id={}: {}"
                   .format(self.id, emarsys_error))
         self.result = 'Emarsys error: {}'.format(emarsys_error)
-        self.result_code = emarsys_error.code
+        self.result_code = str(emarsys_error.code)
         self.state = EventInstance.STATE_ERROR
-        self.save()
+        if save:
+            self.save()
 
-    def handle_success(self):
+    def handle_success(self, save=True):
         self.state = EventInstance.STATE_SUCCESS
-        self.save()
+        if save:
+            self.save()
 
     def label(self):
         return ({
@@ -86,11 +173,12 @@ class EventInstance(models.Model):
             EventInstance.STATE_ERROR: 'important',
             EventInstance.STATE_SUCCESS: 'success'}[self.state], self.state)
 
-    def set_context(self, context):
+    def set_context(self, context, save=True):
         self.context = context
-        self.save()
+        if save:
+            self.save()
 
-    def set_parameter(self, parameter, value):
+    def set_parameter(self, parameter, value, save=True):
         """
         Store the object passed as `value` as for the given `parameter`.
 
@@ -116,6 +204,9 @@ class EventInstance(models.Model):
         if not self.data:
             self.data = {}
 
+        # forget parameters resolved by `resolve_parameters`
+        self.__dict__.pop('_parameters', None)
+
         if parameter.is_string:
             pk = value
         elif parameter.is_list:
@@ -129,7 +220,8 @@ class EventInstance(models.Model):
             pk,
         )
 
-        self.save()
+        if save:
+            self.save()
 
     def get_parameter(self, argument):
         """
@@ -144,6 +236,9 @@ class EventInstance(models.Model):
         if not self.data:
             return None
 
+        if hasattr(self, '_parameters'):
+            return self._parameters[argument]
+
         name, type_, pk = self.data[argument]
         param = EventParam(argument=argument, name=name, type_=type_)
         if param.is_string:
@@ -159,6 +254,9 @@ class EventInstance(models.Model):
         return value, param
 
     def get_all_parameters(self):
+        if hasattr(self, '_parameters'):
+            return dict(self._parameters)
+
         if self.data:
             return {argument: self.get_parameter(argument)
                     for argument in self.data.keys()}
@@ -169,3 +267,36 @@ class EventInstance(models.Model):
 
     def __str__(self):
         return 'at {}: {}'.format(self.when, self.event_name)
+
+
+@python_2_unicode_compatible
+class ContactFingerprint(models.Model):
+    """
+    Hash of the contact data last synced successfully by
+    `api.sync_contacts(..., delta=True)`.
+    """
+    email = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=40)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.email
+
+
+@python_2_unicode_compatible
+class FieldConfiguration(models.Model):
+    """
+    A version of the emarsys field ids and choices, stored by
+    `api.update_field_configuration`. The structure of `fields` and
+    `field_choices` is that of settings.EMARSYS_FIELDS and
+    settings.EMARSYS_FIELD_CHOICES.
+    """
+    fields = JSONField()
+    field_choices = JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        get_latest_by = 'pk'
+
+    def __str__(self):
+        return 'version {} from {}'.format(self.pk, self.created)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Deleting and archiving old `EventInstance` objects.
+
+The retention policy is configured per state in days:
+
+>>> EMARSYS_EVENT_RETENTION = {
+    'success': 30,
+    'error': 180,
+}
+
+States that aren't configured are kept forever.
+"""
+
+from __future__ import unicode_literals
+
+import gzip
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EventInstance
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def get_retention():
+    return getattr(settings, 'EMARSYS_EVENT_RETENTION', {})
+
+
+def purge_event_instances(retention=None, batch_size=BATCH_SIZE, pause=0,
+                          archive_path=None):
+    """
+    Delete event instances older than the retention period of their state,
+    `batch_size` rows per transaction, sleeping `pause` seconds between
+    transactions to keep locks short and replication lag low.
+
+    If `archive_path` is given, deleted rows are first appended to that
+    file as gzip compressed JSON lines.
+
+    :return: {state: number_of_deleted_instances}
+    """
+    if retention is None:
+        retention = get_retention()
+
+    num_deleted = {}
+    archive = gzip.open(archive_path, 'ab') if archive_path else None
+
+    try:
+        for state, days in retention.items():
+            if days is None:
+                continue
+
+            cutoff = timezone.now() - timedelta(days=days)
+            num_deleted[state] = 0
+
+            while True:
+                num_batch_deleted = _purge_batch(state, cutoff, batch_size,
+                                                 archive)
+                if not num_batch_deleted:
+                    break
+
+                num_deleted[state] += num_batch_deleted
+                log.debug("deleted {} event instances in state '{}'"
+                          .format(num_batch_deleted, state))
+
+                if pause:
+                    time.sleep(pause)
+    finally:
+        if archive:
+            archive.close()
+
+    return num_deleted
+
+
+def _purge_batch(state, cutoff, batch_size, archive):
+    with transaction.atomic():
+        pks = list(EventInstance.objects
+                   .filter(state=state, when__lt=cutoff)
+                   .order_by('pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return 0
+
+        if archive:
+            for row in EventInstance.objects.filter(pk__in=pks).values():
+                archive.write(json.dumps(row, cls=DjangoJSONEncoder)
+                              .encode('utf-8') + b'\n')
+            archive.flush()
+
+        EventInstance.objects.filter(pk__in=pks).delete()
+
+    return len(pks)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+settings.EMARSYS_RECIPIENT_WHITELIST restricts which recipients get emails
+and which contacts are synced, e.g. on staging systems. `None` disables it.
+
+Entries are matched case-insensitively and can be
+
+* email addresses: ``'name@domain.org'``
+* domains: ``'@domain.org'``
+* shell-style patterns: ``'qa+*@domain.org'``
+"""
+
+from __future__ import unicode_literals
+
+import fnmatch
+import re
+
+from django.conf import settings
+from django.utils import six
+
+_PATTERN_CHARACTERS = set('*?[')
+
+
+class Whitelist(object):
+    def __init__(self, entries):
+        emails = set()
+        domains = set()
+        patterns = []
+
+        for entry in entries:
+            entry = entry.strip().lower()
+            if _PATTERN_CHARACTERS.intersection(entry):
+                patterns.append(re.compile(fnmatch.translate(entry)))
+            elif entry.startswith('@'):
+                domains.add(entry[1:])
+            else:
+                emails.add(entry)
+
+        self.emails = frozenset(emails)
+        self.domains = frozenset(domains)
+        self.patterns = patterns
+
+    def __contains__(self, email):
+        if not email or not isinstance(email, six.string_types):
+            return False
+
+        email = email.lower()
+
+        if email in self.emails:
+            return True
+
+        if self.domains and email.rpartition('@')[2] in self.domains:
+            return True
+
+        return any(pattern.match(email) for pattern in self.patterns)
+
+
+# (settings.EMARSYS_RECIPIENT_WHITELIST, Whitelist)
+_whitelist = (None, None)
+
+
+def get_whitelist():
+    """
+    Return the `Whitelist` for settings.EMARSYS_RECIPIENT_WHITELIST, or
+    `None` if no whitelist is configured. It's built once for as long as
+    the setting isn't replaced.
+    """
+    global _whitelist
+
+    entries = getattr(settings, 'EMARSYS_RECIPIENT_WHITELIST', None)
+    if entries is None:
+        return None
+
+    cached_entries, whitelist = _whitelist
+    if cached_entries is not entries:
+        whitelist = Whitelist(entries)
+        _whitelist = (entries, whitelist)
+
+    return whitelist
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import tempfile
+
+import mock
+import requests
+from requests.packages.urllib3.exceptions import (
+    MaxRetryError, NewConnectionError, ProtocolError)
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from emarsys import EmarsysError
+
+from django_emarsys import api
+from django_emarsys.models import FieldConfiguration
+
+
+def _response(status_code, json_data):
+    response = mock.Mock(status_code=status_code, text='')
+    response.json.return_value = json_data
+    return response
+
+
+class ClientTestCase(TestCase):
+    @override_settings(EMARSYS_POOL_SIZE=3, EMARSYS_TIMEOUT=(1, 2))
+    def test_client_is_shared_and_configured(self):
+        client = api.Client()
+
+        self.assertIs(client, api.Client())
+        self.assertEqual(client.timeout, (1, 2))
+        self.assertEqual(
+            client.session.get_adapter('https://x')._pool_maxsize, 3)
+
+    def test_call_returns_data(self):
+        client = api.EmarsysClient('account', 'secret', 'https://x/')
+        with mock.patch.object(client.session, 'request') as mock_request:
+            mock_request.return_value = _response(
+                200, {'replyCode': 0, 'replyText': 'OK', 'data': [1]})
+
+            self.assertEqual(client.call('/api/v2/event', 'GET'), [1])
+
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ('GET', 'https://x/api/v2/event'))
+        self.assertTrue(kwargs['headers']['X-WSSE']
+                        .startswith('UsernameToken Username="account"'))
+        self.assertEqual(kwargs['timeout'], api.DEFAULT_TIMEOUT)
+
+    def test_call_raises_emarsys_error(self):
+        client = api.EmarsysClient('account', 'secret', 'https://x')
+        with mock.patch.object(client.session, 'request') as mock_request:
+            mock_request.return_value = _response(
+                400, {'replyCode': 2008, 'replyText': 'No contact found',
+                      'data': ''})
+
+            with self.assertRaises(EmarsysError) as cm:
+                client.call('/api/v2/event/1/trigger', 'POST', {})
+
+        self.assertEqual(cm.exception.code, 2008)
+        self.assertEqual(cm.exception.status_code, 400)
+
+
+def _error(code, status_code):
+    error = EmarsysError('error', code)
+    error.status_code = status_code
+    return error
+
+
+@mock.patch('django_emarsys.api.time.sleep')
+@mock.patch('django_emarsys.api.Client')
+class RetryTestCase(TestCase):
+    def test_transient_errors_are_retried(self, mock_client, mock_sleep):
+        mock_client.return_value.call.side_effect = [
+            _error(6000, 503), _error(6000, 429), ['data']]
+
+        self.assertEqual(api.call_with_attempts('/api/v2/event', 'GET'),
+                         (['data'], 3))
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_terminal_errors_are_not_retried(self, mock_client, mock_sleep):
+        mock_client.return_value.call.side_effect = [_error(2008, 400)]
+
+        with self.assertRaises(EmarsysError) as cm:
+            api.trigger_event(1, 'test.user@machtfit.de', {})
+
+        self.assertEqual(cm.exception.attempts, 1)
+        self.assertFalse(mock_sleep.called)
+
+    def test_sent_posts_are_not_retried(self, mock_client, mock_sleep):
+        mock_client.return_value.call.side_effect = [
+            requests.ConnectionError(ProtocolError('Connection aborted.')),
+            ['data']]
+
+        with self.assertRaises(requests.ConnectionError):
+            api.trigger_event(1, 'test.user@machtfit.de', {})
+
+        self.assertEqual(mock_client.return_value.call.call_count, 1)
+
+    def test_unsent_posts_are_retried(self, mock_client, mock_sleep):
+        mock_client.return_value.call.side_effect = [
+            requests.ConnectionError(MaxRetryError(
+                None, '/api/v2/event/1/trigger',
+                NewConnectionError(None, 'Connection refused'))),
+            requests.ConnectTimeout(),
+            ['data']]
+
+        self.assertEqual(api.trigger_event(1, 'test.user@machtfit.de', {}),
+                         3)
+
+    @override_settings(EMARSYS_RETRY_ATTEMPTS=2)
+    def test_attempts_are_limited(self, mock_client, mock_sleep):
+        mock_client.return_value.call.side_effect = _error(6000, 500)
+
+        with self.assertRaises(EmarsysError) as cm:
+            api.call('/api/v2/event', 'GET')
+
+        self.assertEqual(cm.exception.attempts, 2)
+        self.assertEqual(mock_client.return_value.call.call_count, 2)
+
+
+class RateLimiterTestCase(TestCase):
+    def test_reserve_token(self):
+        state, wait = api._reserve_token(None, 10, 2, 100.0)
+        self.assertEqual((state, wait), ((1, 100.0), 0))
+
+        state, wait = api._reserve_token(state, 10, 2, 100.0)
+        self.assertEqual((state, wait), ((0, 100.0), 0))
+
+        state, wait = api._reserve_token(state, 10, 2, 100.0)
+        self.assertEqual(state, (-1, 100.0))
+        self.assertAlmostEqual(wait, 0.1)
+
+        # the bucket refills with `rate` tokens per second
+        state, wait = api._reserve_token(state, 10, 2, 100.5)
+        self.assertEqual(state, (1, 100.5))
+        self.assertEqual(wait, 0)
+
+    @mock.patch('django_emarsys.api.time')
+    def test_file_backend_limits_per_endpoint_family(self, mock_time):
+        mock_time.time.return_value = 100.0
+        with tempfile.NamedTemporaryFile() as f:
+            limiter = api.RateLimiter(
+                {'contact': (1, 1)}, api.FileRateLimitBackend(f.name))
+
+            limiter.wait('/api/v2/contact')
+            limiter.wait('/api/v2/contactlist/1/add')
+            self.assertFalse(mock_time.sleep.called)
+
+            limiter.wait('/api/v2/contact/getdata')
+            mock_time.sleep.assert_called_once_with(1.0)
+
+    def test_cache_backend_keeps_lock_of_other_process(self):
+        backend = api.CacheRateLimitBackend()
+        backend.LOCK_TIMEOUT = 0
+        lock_key = 'django_emarsys.rate.event.lock'
+        backend.cache.set(lock_key, 'other process')
+
+        try:
+            self.assertEqual(backend.reserve('event', 10, 2), 0)
+            self.assertEqual(backend.cache.get(lock_key), 'other process')
+        finally:
+            backend.cache.delete_many(
+                [lock_key, 'django_emarsys.rate.event'])
+
+    @override_settings(
+        EMARSYS_RATE_LIMITS={'event': (5, 5)},
+        EMARSYS_RATE_LIMIT_BACKEND={
+            'BACKEND': 'django_emarsys.api.FileRateLimitBackend',
+            'OPTIONS': {'path': '/tmp/django_emarsys_rate_limits'}})
+    def test_rate_limiter_from_settings(self):
+        limiter = api.get_rate_limiter()
+
+        self.assertEqual(limiter.limits, {'event': (5, 5)})
+        self.assertIsInstance(limiter.backend, api.FileRateLimitBackend)
+
+
+def _fake_field_api(uri, method, params=None):
+    if uri == '/api/v2/field':
+        return [{'id': 3, 'name': 'E-Mail', 'application_type': 'email'},
+                {'id': 5, 'name': 'Gender',
+                 'application_type': 'singlechoice'},
+                {'id': 100, 'name': 'Interests',
+                 'application_type': 'multichoice'}]
+    return {
+        '/api/v2/field/5/choice': [{'id': '1', 'choice': 'male'},
+                                   {'id': '2', 'choice': 'female'}],
+        '/api/v2/field/100/choice': [{'id': '1', 'choice': 'yoga'}],
+    }[uri]
+
+
+@mock.patch('django_emarsys.api.call', side_effect=_fake_field_api)
+class FieldConfigurationTestCase(TestCase):
+    def test_get_field_choices(self, mock_call):
+        self.assertEqual(api.get_field_choices(workers=2), {
+            'Gender': {'male': 1, 'female': 2},
+            'Interests': {'yoga': 1},
+        })
+
+    @override_settings(EMARSYS_FIELDS=None)
+    def test_transformer_uses_latest_field_configuration(self, mock_call):
+        field_configuration = api.update_field_configuration()
+
+        self.assertEqual(FieldConfiguration.objects.latest(),
+                         field_configuration)
+        self.assertEqual(mock_call.call_count, 3)
+        self.assertEqual(
+            api.get_contact_transformer()({'E-Mail': 'test@machtfit.de',
+                                           'Gender': 'female',
+                                           'Interests': ['yoga']}),
+            {3: 'test@machtfit.de', 5: 2, 100: [1]})
+
+    @override_settings(EMARSYS_FIELDS=None)
+    def test_transformer_picks_up_new_field_configuration(self, mock_call):
+        FieldConfiguration.objects.create(
+            fields={'E-Mail': (3, 'shorttext')}, field_choices={})
+        transformer = api.get_contact_transformer()
+        with self.assertNumQueries(0):
+            self.assertIs(api.get_contact_transformer(), transformer)
+
+        # stored by another process
+        FieldConfiguration.objects.create(
+            fields={'E-Mail': (4, 'shorttext')}, field_choices={})
+
+        with mock.patch('django_emarsys.api.time.time',
+                        return_value=api.time.time() +
+                        api.DEFAULT_FIELD_CONFIGURATION_TTL):
+            self.assertEqual(
+                api.get_contact_transformer()({'E-Mail': 'a@dom.org'}),
+                {4: 'a@dom.org'})
+
+
+@override_settings(EMARSYS_LISTS={'My list': 42})
+class ContactListTestCase(TestCase):
+    @mock.patch('django_emarsys.api.LIST_BATCH_SIZE', 2)
+    @mock.patch('django_emarsys.api.call')
+    def test_replace_contactlist_in_chunks(self, mock_call):
+        mock_call.side_effect = [
+            {'inserted_contacts': 2, 'errors': []},
+            {'inserted_contacts': 0,
+             'errors': {'c@dom.org': {'2008': 'No contact found'}}},
+        ]
+
+        result = api.replace_contactlist(
+            'My list', ['a@dom.org', 'b@dom.org', 'c@dom.org'])
+
+        self.assertEqual(result,
+                         (2, {'c@dom.org': {'2008': 'No contact found'}}))
+        self.assertEqual(mock_call.call_args_list, [
+            mock.call('/api/v2/contactlist/42/replace', 'POST',
+                      {'external_ids': ['a@dom.org', 'b@dom.org']}),
+            mock.call('/api/v2/contactlist/42/add', 'POST',
+                      {'external_ids': ['c@dom.org']}),
+        ])
+
+    @mock.patch('django_emarsys.api.get_list')
+    @mock.patch('django_emarsys.api.call')
+    def test_sync_contactlist_sends_difference(self, mock_call,
+                                               mock_get_list):
+        mock_get_list.return_value = ['1', '2']
+
+        def fake_api(uri, method, params=None):
+            if uri == '/api/v2/contact/getdata':
+                return {'result': [{'id': '2', '3': 'B@dom.org'},
+                                   {'id': '3', '3': 'c@dom.org'}],
+                        'errors': []}
+            if uri == '/api/v2/contactlist/42/add':
+                return {'inserted_contacts': 1, 'errors': []}
+            if uri == '/api/v2/contactlist/42/delete':
+                return {'deleted_contacts': 1, 'errors': []}
+
+        mock_call.side_effect = fake_api
+
+        result = api.sync_contactlist('My list', ['b@dom.org', 'c@dom.org'])
+
+        self.assertEqual(result, (1, 1, {}))
+        mock_call.assert_any_call('/api/v2/contactlist/42/add', 'POST',
+                                  {'external_ids': ['c@dom.org']})
+        mock_call.assert_any_call('/api/v2/contactlist/42/delete', 'POST',
+                                  {'key_id': 'id', 'external_ids': ['1']})
+
+    @mock.patch('django_emarsys.api.call')
+    def test_iter_list_pages(self, mock_call):
+        mock_call.side_effect = [
+            {'value': ['1', '2'],
+             'next': 'https://api.emarsys.net/api/v2/contactlist/42/'
+                     'contactIds?$top=2&$skiptoken=2'},
+            {'value': ['3'], 'next': None},
+        ]
+
+        contact_ids = api.iter_list('My list', page_size=2)
+
+        self.assertEqual(next(contact_ids), '1')
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertEqual(list(contact_ids), ['2', '3'])
+        self.assertEqual(mock_call.call_args_list, [
+            mock.call('/api/v2/contactlist/42/contactIds?$top=2', 'GET'),
+            mock.call('/api/v2/contactlist/42/contactIds'
+                      '?$top=2&$skiptoken=2', 'GET'),
+        ])
+
+
+@override_settings(EMARSYS_FIELDS={'E-Mail': (3, 'shorttext'),
+                                   'First Name': (1, 'shorttext')})
+class ContactDataTestCase(TestCase):
+    @mock.patch('django_emarsys.api.BATCH_SIZE', 2)
+    @mock.patch('django_emarsys.api.call')
+    def test_get_contacts_data(self, mock_call):
+        def fake_api(uri, method, params):
+            return {
+                ('a@dom.org', 'B@dom.org'): {
+                    'result': [{'id': '2', '3': 'b@dom.org', '1': 'B'},
+                               {'id': '1', '3': 'a@dom.org', '1': 'A'}],
+                    'errors': []},
+                ('c@dom.org',): {
+                    'result': False,
+                    'errors': [{'key': 'c@dom.org', 'errorCode': 2008,
+                                'errorMsg': 'No contact found'}]},
+            }[tuple(params['keyValues'])]
+
+        mock_call.side_effect = fake_api
+
+        result = api.get_contacts_data(
+            ['a@dom.org', 'B@dom.org', 'c@dom.org'], fields=['First Name'],
+            workers=2)
+
+        self.assertEqual(list(result), [
+            ('a@dom.org', {'id': '1', 'E-Mail': 'a@dom.org',
+                           'First Name': 'A'}),
+            ('B@dom.org', {'id': '2', 'E-Mail': 'b@dom.org',
+                           'First Name': 'B'}),
+        ])
+        mock_call.assert_any_call('/api/v2/contact/getdata', 'POST',
+                                  {'keyId': '3',
+                                   'keyValues': ['a@dom.org', 'B@dom.org'],
+                                   'fields': ['3', '1']})
+        self.assertEqual(mock_call.call_count, 2)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import threading
+
+import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+from django_emarsys.coalescing import EventCoalescer
+from django_emarsys.event import invalidate_event_id_cache, trigger_event
+from django_emarsys.models import EventInstance
+
+
+class EventCoalescerTestCase(SimpleTestCase):
+    def _send_concurrently(self, coalescer, events):
+        threads = [threading.Thread(target=coalescer.send, args=(event,))
+                   for event in events]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_events_are_batched_per_event_id(self):
+        batches = []
+        coalescer = EventCoalescer(batches.append, window=1,
+                                   max_recipients=2)
+
+        events = [mock.Mock(emarsys_id=1), mock.Mock(emarsys_id=2),
+                  mock.Mock(emarsys_id=1)]
+        self._send_concurrently(coalescer, events)
+
+        self.assertEqual(sorted(len(batch) for batch in batches), [1, 2])
+        self.assertIn([events[1]], batches)
+
+    def test_errors_are_raised_for_every_event(self):
+        errors = []
+
+        def send_batch(events):
+            raise IOError("connection reset")
+
+        def send(event):
+            try:
+                coalescer.send(event)
+            except IOError as e:
+                errors.append(e)
+
+        coalescer = EventCoalescer(send_batch, window=1, max_recipients=2)
+        threads = [threading.Thread(target=send,
+                                    args=(mock.Mock(emarsys_id=1),))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+
+@override_settings(EMARSYS_COALESCE_EVENTS=True, EMARSYS_COALESCE_WINDOW=0)
+class CoalescedTriggerEventTestCase(TestCase):
+    def setUp(self):
+        invalidate_event_id_cache()
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.api.create_contact")
+    @mock.patch("django_emarsys.api.trigger_event_for_contacts")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_trigger_event_creates_missing_contact(
+            self, mock_get_event_id, mock_api_trigger_event_for_contacts,
+            mock_api_create_contact, mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event_for_contacts.return_value = (
+            1, {'new@machtfit.de': {'2008': 'No contact found'}})
+        mock_api_trigger_event.return_value = 1
+
+        event = trigger_event(
+            "test event", 'new@machtfit.de',
+            contact_data_provider=lambda: {'E-Mail': 'new@machtfit.de',
+                                           'First Name': 'New'})
+
+        self.assertEqual(event.state, EventInstance.STATE_SUCCESS)
+        mock_api_trigger_event_for_contacts.assert_called_once_with(
+            1, [('new@machtfit.de', {'global': {}})])
+        mock_api_create_contact.assert_called_once_with(
+            {'E-Mail': 'new@machtfit.de', 'First Name': 'New'})
+        self.assertEqual(
+            sorted(EventInstance.objects.values_list('result_code',
+                                                     flat=True)),
+            ['', '2008'])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import timeit
+from unittest import skipUnless
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django_emarsys.api import ContactTransformer, get_contact_transformer
+
+log = logging.getLogger(__name__)
+
+
+def _transform_with_settings_lookups(contact):
+    """
+    How contacts were transformed before `ContactTransformer`: looking up
+    settings for every value.
+    """
+    def transform_value(name, value):
+        field_type = settings.EMARSYS_FIELDS[name][1]
+        if field_type == 'multichoice':
+            if name in settings.EMARSYS_FIELD_CHOICES:
+                choices = settings.EMARSYS_FIELD_CHOICES[name]
+                return [choices[v] for v in value if v in choices]
+
+        if field_type == 'singlechoice':
+            return settings.EMARSYS_FIELD_CHOICES.get(name, {}).get(value)
+
+        return value
+
+    return {settings.EMARSYS_FIELDS[name][0]: transform_value(name, value)
+            for name, value in contact.items()}
+
+
+FIELDS = {'E-Mail': (3, 'shorttext'),
+          'First Name': (1, 'shorttext'),
+          'Gender': (5, 'singlechoice'),
+          'Interests': (100, 'multichoice'),
+          'Tags': (101, 'multichoice'),
+          'Newsletter': (31, 'singlechoice')}
+
+FIELD_CHOICES = {'Gender': {'male': 1, 'female': 2},
+                 'Interests': {'running': 1, 'yoga': 2, 'swimming': 3}}
+
+
+@override_settings(EMARSYS_FIELDS=FIELDS, EMARSYS_FIELD_CHOICES=FIELD_CHOICES)
+class ContactTransformerTestCase(TestCase):
+    contact = {'E-Mail': 'test.user@machtfit.de',
+               'First Name': 'Test',
+               'Gender': 'female',
+               'Interests': ['yoga', 'chess', 'running'],
+               'Tags': ['a', 'b'],
+               'Newsletter': True}
+
+    def test_transform(self):
+        self.assertEqual(get_contact_transformer()(self.contact),
+                         {3: 'test.user@machtfit.de',
+                          1: 'Test',
+                          5: 2,
+                          100: [2, 1],
+                          101: ['a', 'b'],
+                          31: None})
+        self.assertEqual(get_contact_transformer()(self.contact),
+                         _transform_with_settings_lookups(self.contact))
+
+    def test_transformer_is_rebuilt_when_settings_change(self):
+        transformer = get_contact_transformer()
+        self.assertIs(transformer, get_contact_transformer())
+
+        with self.settings(EMARSYS_FIELD_CHOICES={}):
+            self.assertEqual(get_contact_transformer()(self.contact)[5],
+                             None)
+
+        self.assertIsNot(transformer, get_contact_transformer())
+
+    @skipUnless(os.environ.get('EMARSYS_BENCHMARKS'),
+                "set EMARSYS_BENCHMARKS to run benchmarks")
+    def test_benchmark_100k_contacts(self):
+        contacts = [dict(self.contact, **{'E-Mail': '{}@dom.org'.format(i)})
+                    for i in range(100000)]
+
+        transformer = ContactTransformer(FIELDS, FIELD_CHOICES)
+        compiled = timeit.timeit(
+            lambda: list(map(transformer, contacts)), number=1)
+        with_lookups = timeit.timeit(
+            lambda: list(map(_transform_with_settings_lookups, contacts)),
+            number=1)
+
+        log.info("transforming 100k contacts: %.2fs with settings lookups, "
+                 "%.2fs precompiled", with_lookups, compiled)
+        self.assertLess(compiled, with_lookups)
@@ -27,3 +27,30 @@ class ModelTestCase(TestCase):
         value, restored_param = self.event.get_parameter('user')
         self.assertEqual(value, self.user)
         self.assertEqual(restored_param, param)
+
+    def test_with_parameters(self):
+        user_param = EventParam(argument='user', name='User',
+                                type_='auth.User')
+        users_param = EventParam(argument='users', name='Users',
+                                 type_='[auth.User]')
+        other_user = User.objects.create(username="other_user")
+
+        for _ in range(3):
+            event = EventInstance(event_name='foobar')
+            event.set_parameter(user_param, self.user, save=False)
+            event.set_parameter(users_param, [self.user, other_user],
+                                save=False)
+            event.save()
+
+        with self.assertNumQueries(2):
+            events = list(EventInstance.objects
+                          .filter(event_name='foobar')
+                          .exclude(pk=self.event.pk)
+                          .with_parameters())
+            parameters = [event.get_all_parameters() for event in events]
+
+        self.assertEqual(len(parameters), 3)
+        for event_parameters in parameters:
+            self.assertEqual(event_parameters['user'], (self.user, user_param))
+            self.assertEqual(event_parameters['users'],
+                             ([self.user, other_user], users_param))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django_emarsys.models import EventInstance
+from django_emarsys.retention import purge_event_instances
+
+
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        for state in [EventInstance.STATE_SUCCESS,
+                      EventInstance.STATE_ERROR,
+                      EventInstance.STATE_SENDING]:
+            for age in [10, 100]:
+                event = EventInstance.objects.create(
+                    event_name='test event', state=state, data={})
+                EventInstance.objects.filter(pk=event.pk).update(
+                    when=timezone.now() - timedelta(days=age))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @override_settings(EMARSYS_EVENT_RETENTION={'success': 5, 'error': 50})
+    def test_purge_event_instances(self):
+        archive_path = os.path.join(self.tempdir, 'events.jsonl.gz')
+
+        num_deleted = purge_event_instances(batch_size=1,
+                                            archive_path=archive_path)
+
+        self.assertEqual(num_deleted, {'success': 2, 'error': 1})
+        self.assertEqual(
+            sorted(EventInstance.objects.values_list('state', flat=True)),
+            ['error', 'sending', 'sending'])
+
+        with gzip.open(archive_path, 'rb') as f:
+            rows = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual(sorted(row['state'] for row in rows),
+                         ['error', 'success', 'success'])
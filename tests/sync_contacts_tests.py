@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django_emarsys.api import sync_contacts
+from django_emarsys.models import ContactFingerprint
+
+
+@override_settings(
+    EMARSYS_FIELDS={'E-Mail': (3, 'shorttext'),
+                    'First Name': (1, 'shorttext'),
+                    'Opt-In': (31, 'singlechoice')},
+    EMARSYS_FIELD_CHOICES={'Opt-In': {True: 1, False: 2}},
+    EMARSYS_CREATE_ONLY_FIELDS=['Opt-In'],
+    EMARSYS_RECIPIENT_WHITELIST=None)
+class SyncContactsTestCase(TestCase):
+    contacts = [
+        {'E-Mail': 'a@machtfit.de', 'First Name': 'Ä', 'Opt-In': True},
+        {'E-Mail': 'b@machtfit.de', 'First Name': 'B', 'Opt-In': False},
+        {'E-Mail': 'c@machtfit.de', 'First Name': 'C', 'Opt-In': True},
+    ]
+
+    @mock.patch("django_emarsys.api._create_contacts")
+    @mock.patch("django_emarsys.api._update_contacts")
+    def test_sync_contacts_creates_missing_contacts(
+            self, mock_update_contacts, mock_create_contacts):
+        mock_update_contacts.return_value = (
+            1, {'b@machtfit.de': {'2008': 'No contact found'},
+                'c@machtfit.de': {'2008': 'No contact found'}})
+        mock_create_contacts.return_value = (2, {})
+
+        result = sync_contacts(self.contacts)
+
+        self.assertEqual(result, (1, 2, [], []))
+        mock_update_contacts.assert_called_once_with([
+            {3: 'a@machtfit.de', 1: 'Ä'},
+            {3: 'b@machtfit.de', 1: 'B'},
+            {3: 'c@machtfit.de', 1: 'C'},
+        ])
+        created_contacts, = mock_create_contacts.call_args[0]
+        self.assertEqual(
+            sorted(created_contacts, key=lambda contact: contact[3]),
+            [{3: 'b@machtfit.de', 1: 'B', 31: 2},
+             {3: 'c@machtfit.de', 1: 'C', 31: 1}])
+
+    @mock.patch("django_emarsys.api._create_contacts")
+    @mock.patch("django_emarsys.api._update_contacts")
+    def test_sync_contacts_without_create_missing(
+            self, mock_update_contacts, mock_create_contacts):
+        mock_update_contacts.return_value = (
+            2, {'b@machtfit.de': {'2008': 'No contact found'},
+                'c@machtfit.de': {'2010': 'Invalid email'}})
+
+        result = sync_contacts(self.contacts, create_missing=False)
+
+        self.assertEqual(result, (
+            2, 0, ['b@machtfit.de'],
+            [('c@machtfit.de', {'2010': 'Invalid email'})]))
+        self.assertFalse(mock_create_contacts.called)
+
+    @mock.patch("django_emarsys.api.BATCH_SIZE", 2)
+    @mock.patch("django_emarsys.api._create_contacts")
+    @mock.patch("django_emarsys.api._update_contacts")
+    def test_sync_contacts_creates_missing_contacts_per_chunk(
+            self, mock_update_contacts, mock_create_contacts):
+        calls = []
+
+        def update_contacts(contacts):
+            calls.append(('update', [contact[3] for contact in contacts]))
+            return 0, {contact[3]: {'2008': 'No contact found'}
+                       for contact in contacts}
+
+        def create_contacts(contacts):
+            calls.append(('create', [contact[3] for contact in contacts]))
+            return len(contacts), {}
+
+        mock_update_contacts.side_effect = update_contacts
+        mock_create_contacts.side_effect = create_contacts
+
+        result = sync_contacts(contact for contact in self.contacts)
+
+        self.assertEqual(result, (0, 3, [], []))
+        self.assertEqual(calls, [
+            ('update', ['a@machtfit.de', 'b@machtfit.de']),
+            ('create', ['a@machtfit.de', 'b@machtfit.de']),
+            ('update', ['c@machtfit.de']),
+            ('create', ['c@machtfit.de']),
+        ])
+
+    @mock.patch("django_emarsys.api.BATCH_SIZE", 1)
+    @mock.patch("django_emarsys.api._create_contacts")
+    @mock.patch("django_emarsys.api._update_contacts")
+    def test_sync_contacts_with_workers(
+            self, mock_update_contacts, mock_create_contacts):
+        def update_contacts(contacts):
+            email = contacts[0][3]
+            if email == 'a@machtfit.de':
+                return 1, {}
+            return 0, {email: {'2008': 'No contact found'}}
+
+        mock_update_contacts.side_effect = update_contacts
+
+        result = sync_contacts(self.contacts, create_missing=False,
+                               workers=3, max_in_flight=2)
+
+        self.assertEqual(result,
+                         (1, 0, ['b@machtfit.de', 'c@machtfit.de'], []))
+        self.assertEqual(mock_update_contacts.call_count, 3)
+
+    @mock.patch("django_emarsys.api._create_contacts")
+    @mock.patch("django_emarsys.api._update_contacts")
+    def test_sync_contacts_delta(self, mock_update_contacts,
+                                 mock_create_contacts):
+        mock_update_contacts.side_effect = lambda contacts: (
+            len(contacts) - 1,
+            {'c@machtfit.de': {'2010': 'Invalid email'}})
+
+        self.assertEqual(sync_contacts(self.contacts, delta=True)[0], 2)
+        self.assertEqual(ContactFingerprint.objects.count(), 2)
+
+        contacts = [dict(contact) for contact in self.contacts]
+        contacts[1]['First Name'] = 'Bee'
+
+        self.assertEqual(sync_contacts(contacts, delta=True)[0], 1)
+
+        sent_emails = [contact[3] for contact
+                       in mock_update_contacts.call_args[0][0]]
+        # c@ failed the first time and is sent again
+        self.assertEqual(sent_emails, ['b@machtfit.de', 'c@machtfit.de'])
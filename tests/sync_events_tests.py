@@ -133,3 +133,26 @@ class SyncEventTestCase(TestCase):
         mock_event_log.warning.assert_called_with(
             'these event names in settings.EMARSYS_EVENTS '
             'are not known by Emarsys: "unsynced event näme"')
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.get_events")
+    def test_sync_events_without_changes_does_not_write(self,
+                                                        mock_api_get_events):
+        mock_api_get_events.return_value = {
+            'töst event 1': 1,
+        }
+        settings.EMARSYS_EVENTS = {
+            'töst event 1': {
+            },
+        }
+
+        Event.objects.create(name='töst event 1', emarsys_id=1)
+
+        with self.assertNumQueries(1):
+            num_new_events, num_updated_ids, num_deleted_ids, \
+                unsynced_event_names = sync_events()
+
+        self.assertEqual(
+            (num_new_events, num_updated_ids, num_deleted_ids,
+             unsynced_event_names),
+            (0, 0, 0, []))
@@ -2,15 +2,24 @@
 
 from __future__ import unicode_literals
 
+from datetime import timedelta
+
 import mock
+import requests
 
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 from django.contrib.auth.models import User
 
-from django_emarsys.event import trigger_event
-from django_emarsys.models import EventInstance
+from emarsys import EmarsysError
+
+from django_emarsys.event import (get_all_parameters_for_event,
+                                  get_event_id, invalidate_event_id_cache,
+                                  send_queued_events, trigger_event,
+                                  trigger_events)
+from django_emarsys.models import Event, EventInstance
 
 
 class TriggerEventTestCase(TestCase):
@@ -24,6 +33,9 @@ class TriggerEventTestCase(TestCase):
     def tearDownClass(cls):
         cls.user.delete()
 
+    def setUp(self):
+        invalidate_event_id_cache()
+
     @override_settings()
     @mock.patch("django_emarsys.api.get_events")
     def test_trigger_event_with_unknown_name(self, mock_api_get_events):
@@ -82,6 +94,7 @@ class TriggerEventTestCase(TestCase):
 
         TEST_EVENT_ID = 1
         mock_api_get_events.return_value = {'test event': TEST_EVENT_ID}
+        mock_api_trigger_event.return_value = 1
 
         event = trigger_event("test event", self.user.email,
                               data=dict(extra_user=self.user))
@@ -107,6 +120,7 @@ class TriggerEventTestCase(TestCase):
 
         TEST_EVENT_ID = 1
         mock_api_get_events.return_value = {'test event': TEST_EVENT_ID}
+        mock_api_trigger_event.return_value = 1
 
         event = trigger_event("test event", self.user.email,
                               data=dict(extra_user=self.user),
@@ -119,3 +133,318 @@ class TriggerEventTestCase(TestCase):
         mock_api_get_events.assert_called_with()
         mock_api_trigger_event.assert_called_with(
             TEST_EVENT_ID, self.user.email, {'global': {}})
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True)
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.api.get_events")
+    def test_trigger_queued_event(self, mock_api_get_events,
+                                  mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'extra_user': ("User", "auth.User"),
+            },
+        }
+
+        TEST_EVENT_ID = 1
+        mock_api_get_events.return_value = {'test event': TEST_EVENT_ID}
+        mock_api_trigger_event.return_value = 1
+
+        event = trigger_event("test event", self.user.email,
+                              data=dict(extra_user=self.user))
+        self.assertEqual(event.state, EventInstance.STATE_SENDING)
+        self.assertFalse(mock_api_trigger_event.called)
+
+        num_sent_events, num_failed_events = send_queued_events()
+
+        self.assertEqual((num_sent_events, num_failed_events), (1, 0))
+        self.assertEqual(EventInstance.objects.get(pk=event.pk).state,
+                         EventInstance.STATE_SUCCESS)
+        mock_api_trigger_event.assert_called_with(
+            TEST_EVENT_ID, self.user.email, {'global': {}})
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True)
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.api.get_events")
+    def test_send_queued_events_in_threads(self, mock_api_get_events,
+                                           mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'extra_user': ("User", "auth.User"),
+            },
+        }
+        mock_api_get_events.return_value = {'test event': 1}
+        mock_api_trigger_event.return_value = 1
+
+        events = [trigger_event("test event", self.user.email,
+                                data=dict(extra_user=self.user))
+                  for _ in range(5)]
+
+        # claimed by another worker
+        EventInstance.objects.filter(pk=events[0].pk).update(
+            locked_until=timezone.now() + timedelta(minutes=5))
+
+        num_sent_events, num_failed_events = send_queued_events(
+            threads=2, batch_size=2)
+
+        self.assertEqual((num_sent_events, num_failed_events), (4, 0))
+        self.assertEqual(mock_api_trigger_event.call_count, 4)
+        self.assertEqual(EventInstance.objects.get(pk=events[0].pk).state,
+                         EventInstance.STATE_SENDING)
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True)
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_queued_event_attempts_are_counted_once(self, mock_get_event_id,
+                                                    mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        error = EmarsysError("Invalid email", 2010)
+        error.attempts = 3
+        mock_api_trigger_event.side_effect = error
+
+        event = trigger_event("test event", self.user.email)
+        send_queued_events()
+
+        event = EventInstance.objects.get(pk=event.pk)
+        self.assertEqual(event.state, EventInstance.STATE_ERROR)
+        self.assertEqual(event.attempts, 3)
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True)
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_queued_event_fails_if_it_may_have_been_sent(
+            self, mock_get_event_id, mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event.side_effect = requests.ReadTimeout()
+
+        event = trigger_event("test event", self.user.email)
+
+        self.assertEqual(send_queued_events(), (0, 1))
+        self.assertEqual(EventInstance.objects.get(pk=event.pk).state,
+                         EventInstance.STATE_ERROR)
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True,
+                       EMARSYS_QUEUE_MAX_ATTEMPTS=2)
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_queued_event_is_retried_after_connect_error(
+            self, mock_get_event_id, mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event.side_effect = requests.ConnectTimeout()
+
+        event = trigger_event("test event", self.user.email)
+
+        send_queued_events()
+        self.assertEqual(EventInstance.objects.get(pk=event.pk).state,
+                         EventInstance.STATE_SENDING)
+
+        # the lease expired
+        EventInstance.objects.update(locked_until=None)
+        send_queued_events()
+
+        event = EventInstance.objects.get(pk=event.pk)
+        self.assertEqual(event.state, EventInstance.STATE_ERROR)
+        self.assertEqual(event.attempts, 2)
+
+    @override_settings(EMARSYS_QUEUE_EVENTS=True)
+    @mock.patch("django_emarsys.api.create_contact")
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_queued_event_without_create_user_if_needed(
+            self, mock_get_event_id, mock_api_trigger_event,
+            mock_api_create_contact):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event.side_effect = EmarsysError(
+            "No contact found", 2008)
+
+        event = trigger_event("test event", 'new@machtfit.de',
+                              create_user_if_needed=False)
+        send_queued_events()
+
+        event = EventInstance.objects.get(pk=event.pk)
+        self.assertEqual(event.state, EventInstance.STATE_ERROR)
+        self.assertEqual(event.result_code, '2008')
+        self.assertFalse(mock_api_create_contact.called)
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.create_contacts")
+    @mock.patch("django_emarsys.api.trigger_event_for_contacts")
+    @mock.patch("django_emarsys.api.get_events")
+    def test_trigger_events(self, mock_api_get_events,
+                            mock_api_trigger_event_for_contacts,
+                            mock_api_create_contacts):
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'extra_user': ("User", "auth.User"),
+            },
+        }
+        mock_api_get_events.return_value = {'test event': 1}
+        mock_api_trigger_event_for_contacts.side_effect = [
+            (1, {'new@machtfit.de': {'2008': 'No contact found'},
+                 'bad@machtfit.de': {'2010': 'Invalid email'}}),
+            (1, {}),
+        ]
+
+        events = trigger_events("test event", [
+            (self.user.email, dict(extra_user=self.user)),
+            ('new@machtfit.de', dict(extra_user=self.user)),
+            ('bad@machtfit.de', dict(extra_user=self.user)),
+            ('invalid@machtfit.de', dict(obj=self.user)),
+        ])
+
+        self.assertEqual([event.state for event in events],
+                         [EventInstance.STATE_SUCCESS,
+                          EventInstance.STATE_SUCCESS,
+                          EventInstance.STATE_ERROR,
+                          EventInstance.STATE_ERROR])
+        self.assertEqual(events[2].result_code, '2010')
+        self.assertEqual(events[1].attempts, 2)
+        self.assertEqual(EventInstance.objects.count(), 4)
+
+        self.assertEqual(mock_api_trigger_event_for_contacts.call_count, 2)
+        mock_api_trigger_event_for_contacts.assert_called_with(
+            1, [('new@machtfit.de', {'global': {}})])
+        self.assertEqual(list(mock_api_create_contacts.call_args[0][0]),
+                         [{'E-Mail': 'new@machtfit.de'}])
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.BATCH_SIZE", 1)
+    @mock.patch("django_emarsys.api.trigger_event_for_contacts")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_trigger_events_stores_sent_batches(
+            self, mock_get_event_id, mock_api_trigger_event_for_contacts):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event_for_contacts.side_effect = [
+            (1, {}), requests.ConnectionError("connection reset")]
+
+        events = trigger_events("test event", [
+            ('a@machtfit.de', None),
+            ('b@machtfit.de', None),
+        ])
+
+        self.assertEqual([event.state for event in events],
+                         [EventInstance.STATE_SUCCESS,
+                          EventInstance.STATE_ERROR])
+        self.assertEqual(events[1].result,
+                         "Sending failed: connection reset")
+        self.assertEqual(EventInstance.objects.count(), 2)
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.create_contacts")
+    @mock.patch("django_emarsys.api.trigger_event_for_contacts")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_trigger_events_stores_batch_before_raising(
+            self, mock_get_event_id, mock_api_trigger_event_for_contacts,
+            mock_api_create_contacts):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event_for_contacts.return_value = (
+            1, {'new@machtfit.de': {'2008': 'No contact found'}})
+        mock_api_create_contacts.side_effect = EmarsysError(
+            "Service unavailable", 6000)
+
+        with self.assertRaises(EmarsysError):
+            trigger_events("test event", [
+                ('a@machtfit.de', None),
+                ('new@machtfit.de', None),
+            ])
+
+        self.assertEqual(
+            dict(EventInstance.objects.values_list('recipient_email',
+                                                   'state')),
+            {'a@machtfit.de': EventInstance.STATE_SUCCESS,
+             'new@machtfit.de': EventInstance.STATE_ERROR})
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_trigger_event_takes_a_single_write(self, mock_get_event_id,
+                                                mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'extra_user': ("User", "auth.User"),
+            },
+        }
+        mock_get_event_id.return_value = 1
+        mock_api_trigger_event.return_value = 1
+
+        with self.assertNumQueries(1):
+            event = trigger_event("test event", self.user.email,
+                                  data=dict(extra_user=self.user))
+
+        self.assertEqual(EventInstance.objects.get(pk=event.pk).state,
+                         EventInstance.STATE_SUCCESS)
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.trigger_event")
+    @mock.patch("django_emarsys.event.get_event_id")
+    def test_trigger_event_stores_connection_error(self, mock_get_event_id,
+                                                   mock_api_trigger_event):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_get_event_id.return_value = 1
+        error = requests.ConnectionError("connection reset")
+        error.attempts = 2
+        mock_api_trigger_event.side_effect = error
+
+        with self.assertRaises(requests.ConnectionError):
+            trigger_event("test event", self.user.email)
+
+        event = EventInstance.objects.get()
+        self.assertEqual(event.state, EventInstance.STATE_ERROR)
+        self.assertEqual(event.result, "Sending failed: connection reset")
+        self.assertEqual(event.attempts, 2)
+
+    def test_event_id_is_cached(self):
+        event = Event.objects.create(name='test event', emarsys_id=1)
+
+        self.assertEqual(get_event_id('test event'), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_event_id('test event'), 1)
+
+        event.emarsys_id = 2
+        event.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get_event_id('test event'), 2)
+
+    @override_settings()
+    @mock.patch("django_emarsys.api.get_events")
+    def test_unknown_event_id_is_not_synced_again(self,
+                                                  mock_api_get_events):
+        settings.EMARSYS_EVENTS = {'test event': {}}
+        mock_api_get_events.return_value = {}
+
+        self.assertIsNone(get_event_id('test event'))
+        self.assertIsNone(get_event_id('test event'))
+        self.assertEqual(mock_api_get_events.call_count, 1)
+
+        mock_api_get_events.return_value = {'test event': 1}
+        invalidate_event_id_cache()
+
+        self.assertEqual(get_event_id('test event'), 1)
+        self.assertEqual(mock_api_get_events.call_count, 2)
+
+    @override_settings()
+    def test_event_parameters_are_cached(self):
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'extra_user': ("User", "auth.User"),
+            },
+        }
+
+        params = get_all_parameters_for_event('test event')
+        self.assertIs(params, get_all_parameters_for_event('test event'))
+        self.assertIs(params['extra_user']._model_class, User)
+
+        settings.EMARSYS_EVENTS = {
+            'test event': {
+                'name': ("Name", "string"),
+            },
+        }
+
+        self.assertEqual(list(get_all_parameters_for_event('test event')),
+                         ['name'])
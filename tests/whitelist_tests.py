@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django_emarsys.whitelist import Whitelist, get_whitelist
+
+
+class WhitelistTestCase(TestCase):
+    def test_whitelist(self):
+        whitelist = Whitelist(['Test.User@machtfit.de',
+                               '@example.org',
+                               'qa+*@machtfit.de'])
+
+        self.assertIn('test.user@machtfit.de', whitelist)
+        self.assertIn('TEST.USER@MACHTFIT.DE', whitelist)
+        self.assertIn('anyone@example.org', whitelist)
+        self.assertIn('qa+123@machtfit.de', whitelist)
+
+        self.assertNotIn('other.user@machtfit.de', whitelist)
+        self.assertNotIn('anyone@sub.example.org', whitelist)
+        self.assertNotIn('qa@machtfit.de', whitelist)
+        self.assertNotIn(None, whitelist)
+        self.assertNotIn('', whitelist)
+
+    @override_settings(EMARSYS_RECIPIENT_WHITELIST=None)
+    def test_no_whitelist(self):
+        self.assertIsNone(get_whitelist())
+
+    @override_settings(EMARSYS_RECIPIENT_WHITELIST=['a@machtfit.de'])
+    def test_get_whitelist(self):
+        whitelist = get_whitelist()
+
+        self.assertIs(whitelist, get_whitelist())
+        self.assertEqual(whitelist.emails, frozenset(['a@machtfit.de']))